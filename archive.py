@@ -0,0 +1,226 @@
+import image
+
+import argparse
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+MAGIC = b'GBPARC1\n'
+#marker, seconds since the epoch, length of the metadata, length of the gbtile data
+RECORD = struct.Struct('<4sdII')
+MARKER = b'PRNT'
+#byte offset of every record, in a file next to the archive
+INDEX = struct.Struct('<Q')
+PAGE_SIZE = 640
+
+
+class ArchivedPrint:
+    """
+    One print in an archive. gbtile is a view straight into the memory
+    mapped archive, it is only decoded when an image is asked for.
+    """
+    __slots__ = ('number', 'timestamp', 'palette', 'port', 'gbtile')
+
+    def __init__(self, number, timestamp, palette, port, gbtile):
+        self.number = number
+        self.timestamp = timestamp
+        self.palette = palette
+        self.port = port
+        self.gbtile = gbtile
+
+    @property
+    def pages(self):
+        return len(self.gbtile) // PAGE_SIZE
+
+    def image(self, palette=None):
+        """PIL image in palette, or the palette it was printed with"""
+        return image.gbtile_to_image(self.gbtile, palette=palette or self.palette)
+
+    def export_png(self, directory='gbp_out', palette=None):
+        """Write the print as a PNG named after when it was printed, returns the path"""
+        os.makedirs(directory, exist_ok=True)
+        stamp = time.strftime('gbp_%Y%m%d_%H%M%S', time.localtime(self.timestamp))
+        return image.write_png(self.image(palette), directory, stamp)
+
+    def __repr__(self):
+        return f'ArchivedPrint(number={self.number}, pages={self.pages}, ' \
+               f'palette={self.palette!r}, port={self.port!r})'
+
+
+class PrintArchive:
+    """
+    Completed prints appended to one file as the raw gbtile bytes the
+    printer received, 2 bits a pixel, with their timestamp, palette and
+    source port. PNGs are only made when a print is exported, in whatever
+    palette is wanted then.
+
+    Records are located through an index file of fixed size offsets, so any
+    print is found without reading the ones before it, and are read through
+    a memory map without copying. The index entry is only written once the
+    record is complete, and a missing or short index is rebuilt from the
+    archive on open.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.index_path = path + '.idx'
+        self._lock = threading.Lock()
+        self._file = open(path, 'a+b')
+        if self._file.seek(0, os.SEEK_END) == 0:
+            self._file.write(MAGIC)
+            self._file.flush()
+        self._file.seek(0)
+        if self._file.read(len(MAGIC)) != MAGIC:
+            self._file.close()
+            raise ValueError(f'{path} is not a print archive')
+        self._index = open(self.index_path, 'a+b')
+        self._map = None
+        self._index_map = None
+        self._check_index()
+
+    def _check_index(self):
+        """
+        Drop index entries for records that never got finished, index any
+        complete records the index is missing, and cut off a half written
+        record at the end
+        """
+        size = os.path.getsize(self.path)
+        index_size = os.path.getsize(self.index_path)
+        self._index.seek(0)
+        offsets = [offset for offset, in
+                   INDEX.iter_unpack(self._index.read(index_size - index_size % INDEX.size))]
+        while offsets and self._record_end(offsets[-1], size) is None:
+            offsets.pop()
+        end = self._record_end(offsets[-1], size) if offsets else len(MAGIC)
+        while True:
+            next_end = self._record_end(end, size)
+            if next_end is None:
+                break
+            offsets.append(end)
+            end = next_end
+        if end < size:
+            log.warning(f'Dropping {size - end} bytes of unfinished print from {self.path}')
+            self._file.truncate(end)
+        if len(offsets)*INDEX.size != index_size:
+            self._index.truncate(0)
+            self._index.write(b''.join(INDEX.pack(offset) for offset in offsets))
+            self._index.flush()
+        self._count = len(offsets)
+
+    def _record_end(self, offset, size):
+        """Where the record at offset ends, or None if it is not all there"""
+        if offset + RECORD.size > size:
+            return None
+        self._file.seek(offset)
+        marker, _, meta_length, data_length = RECORD.unpack(self._file.read(RECORD.size))
+        end = offset + RECORD.size + meta_length + data_length
+        if marker != MARKER or end > size:
+            return None
+        return end
+
+    def __len__(self):
+        return self._count
+
+    def append(self, gbtile, palette='gray', port=None, timestamp=None):
+        """Add a print, returns its number"""
+        if timestamp is None:
+            timestamp = time.time()
+        meta = json.dumps({'palette': palette, 'port': port}).encode('utf-8')
+        gbtile = memoryview(gbtile).cast('B')
+        with self._lock:
+            offset = self._file.seek(0, os.SEEK_END)
+            self._file.write(RECORD.pack(MARKER, timestamp, len(meta), len(gbtile)))
+            self._file.write(meta)
+            self._file.write(gbtile)
+            self._file.flush()
+            self._index.write(INDEX.pack(offset))
+            self._index.flush()
+            self._count += 1
+            return self._count - 1
+
+    def _maps(self):
+        """
+        Memory maps of the archive and index covering every print so far,
+        remapped when prints have been added since
+        """
+        if self._index_map is None or len(self._index_map) < self._count*INDEX.size:
+            self._close_maps()
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._index_map = mmap.mmap(self._index.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map, self._index_map
+
+    def __getitem__(self, number):
+        if number < 0:
+            number += self._count
+        if not 0 <= number < self._count:
+            raise IndexError(f'No print {number} in {self.path}')
+        with self._lock:
+            data, index = self._maps()
+            offset, = INDEX.unpack_from(index, number*INDEX.size)
+            _, timestamp, meta_length, data_length = RECORD.unpack_from(data, offset)
+            start = offset + RECORD.size
+            meta = json.loads(bytes(data[start:start+meta_length]))
+            gbtile = memoryview(data)[start+meta_length:start+meta_length+data_length]
+        palette = meta['palette']
+        if isinstance(palette, list):
+            palette = tuple(palette)
+        return ArchivedPrint(number, timestamp, palette, meta['port'], gbtile)
+
+    def __iter__(self):
+        for number in range(len(self)):
+            yield self[number]
+
+    def _close_maps(self):
+        for old in (self._map, self._index_map):
+            if old is not None:
+                try:
+                    old.close()
+                except BufferError:
+                    pass #a print still uses it, it closes once that is gone
+        self._map = self._index_map = None
+
+    def close(self):
+        self._close_maps()
+        self._file.close()
+        self._index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='List or export the prints in an archive')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    list_parser = subparsers.add_parser('list')
+    list_parser.add_argument('path', help='archive file')
+    export_parser = subparsers.add_parser('export')
+    export_parser.add_argument('path', help='archive file')
+    export_parser.add_argument('numbers', nargs='*', type=int,
+                               help='prints to export, all of them if none given')
+    export_parser.add_argument('--palette', choices=image.PALETTES,
+                               help='palette to export in instead of the original')
+    export_parser.add_argument('--out', default='gbp_out', help='output folder')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    with PrintArchive(args.path) as archive:
+        if args.command == 'list':
+            for pr in archive:
+                when = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(pr.timestamp))
+                print(f'{pr.number:5d}  {when}  {pr.pages:4d} pages  '
+                      f'{pr.palette}  {pr.port or ""}')
+        else:
+            for number in args.numbers or range(len(archive)):
+                print(archive[number].export_png(args.out, args.palette))
+
+
+if __name__ == '__main__':
+    main()
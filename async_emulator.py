@@ -0,0 +1,119 @@
+import emulator
+import image
+
+import asyncio
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class AsyncSource:
+    """
+    What the async engine reads lines from. read_line returns the next line,
+    an empty bytestring if none arrived within the timeout, or None once the
+    source has run dry.
+    """
+    async def init(self):
+        pass
+
+    async def read_line(self, timeout=1):
+        raise NotImplementedError
+
+    async def shutdown(self):
+        pass
+
+
+class ThreadedSource(AsyncSource):
+    """
+    Wraps a blocking source with init/get_line/shutdown, GBSerial by default,
+    and runs its calls on a worker thread so the event loop never blocks
+    """
+    def __init__(self, source=None):
+        self.source = source if source else emulator.GBSerial()
+
+    async def init(self):
+        await asyncio.to_thread(self.source.init)
+
+    async def read_line(self, timeout=1):
+        return await asyncio.to_thread(self.source.get_line, timeout)
+
+    async def shutdown(self):
+        await asyncio.to_thread(self.source.shutdown)
+
+
+class MemorySource(AsyncSource):
+    """
+    Lines handed over with feed(), mostly for tests. After close() the lines
+    already fed are still read, then the source runs dry.
+    """
+    def __init__(self, lines=()):
+        self._queue = asyncio.Queue()
+        self._closed = False
+        for line in lines:
+            self.feed(line)
+
+    def feed(self, line):
+        self._queue.put_nowait(line)
+
+    def close(self):
+        self._queue.put_nowait(None)
+
+    async def read_line(self, timeout=1):
+        if self._closed:
+            return None
+        try:
+            line = await asyncio.wait_for(self._queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return b''
+        if line is None:
+            self._closed = True
+        return line
+
+
+class AsyncEmulator:
+    """
+    Drives an Emulator from an AsyncSource. Packets go through the same
+    parse_line and handle_packet as the blocking loop, so any number of
+    these can share one event loop, one per dongle.
+    """
+    def __init__(self, emu=None, **kwargs):
+        self.log = logging.getLogger('AsyncEmulator')
+        self.emulator = emu if emu else emulator.Emulator(**kwargs)
+        self.source = None
+
+    async def init(self, source=None):
+        self.log.debug('Begin to init')
+        self.source = source if source else ThreadedSource()
+        await self.source.init()
+        self.emulator.reset()
+        self.log.debug('Emulator is init')
+
+    async def shutdown(self):
+        await self.source.shutdown()
+        self.emulator.running = False
+        await asyncio.to_thread(image.save_queue.flush)
+
+    async def packets(self):
+        """Yields every packet parsed from the source until it runs dry"""
+        while self.emulator.running:
+            line = await self.source.read_line()
+            if line is None:
+                break
+            packet = self.emulator.parse_line(line)
+            if packet:
+                yield packet
+
+    async def images(self):
+        """
+        Handles every packet and yields the (image, status) pairs that come
+        out of it, status being 'partial' or 'complete'
+        """
+        async for packet in self.packets():
+            ret = self.emulator.handle_packet(packet)
+            if ret and ret[0] is not None:
+                yield ret
+
+    async def run_forever(self):
+        async for packet in self.packets():
+            self.emulator.handle_packet(packet)
+            log.debug(f'Current status: {self.emulator.status_text}')
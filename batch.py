@@ -0,0 +1,172 @@
+import image
+
+import argparse
+import json
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+log = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif', '.webp', '.tif', '.tiff')
+MANIFEST = 'manifest.json'
+#results between manifest rewrites, so a killed batch only redoes the last few
+MANIFEST_EVERY = 16
+
+
+def convert_file(src, dst, dither_mode='bayer', rotate='auto', align='center'):
+    """
+    Runs one image through image_to_gbtile and writes the result to dst.
+    Returns the manifest entry for it. Runs in a worker process.
+    """
+    start = time.perf_counter()
+    gbtile = image.image_to_gbtile(src, dither_mode=dither_mode,
+                                   rotate=rotate, align=align)
+    os.makedirs(os.path.dirname(dst) or '.', exist_ok=True)
+    tmp = dst + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(gbtile)
+    os.replace(tmp, dst)
+    return {
+        'input': src,
+        'output': dst,
+        'bytes': len(gbtile),
+        'rows': len(gbtile) // 40,
+        'pages': len(gbtile) / 640,
+        'seconds': time.perf_counter() - start,
+    }
+
+
+def find_inputs(paths, out_dir):
+    """
+    Pairs every image found in paths with its output path. Folders are
+    searched recursively and their layout is kept under out_dir. Outputs
+    keep the input's extension, so a.png and a.jpg don't overwrite each
+    other, and a ValueError is raised if two inputs still map to one output.
+    """
+    pairs = []
+    for path in paths:
+        if os.path.isdir(path):
+            for folder, _, files in os.walk(path):
+                for name in sorted(files):
+                    if name.lower().endswith(IMAGE_EXTENSIONS):
+                        src = os.path.join(folder, name)
+                        rel = os.path.relpath(src, path)
+                        pairs.append((src, os.path.join(out_dir, rel + '.gbtile')))
+        else:
+            pairs.append((path, os.path.join(out_dir, os.path.basename(path) + '.gbtile')))
+    unique = {}
+    for src, dst in pairs:
+        key = os.path.normcase(os.path.normpath(dst))
+        if key not in unique:
+            unique[key] = src, dst
+        elif os.path.abspath(unique[key][0]) != os.path.abspath(src):
+            raise ValueError(f'{unique[key][0]} and {src} would both be written to {dst}')
+    return list(unique.values())
+
+
+def up_to_date(src, dst, options, previous):
+    """True if dst is newer than src and was made with the same options"""
+    entry = previous.get(dst)
+    if not entry or entry.get('options') != options:
+        return False
+    try:
+        return os.path.getmtime(dst) >= os.path.getmtime(src)
+    except OSError:
+        return False
+
+
+def load_manifest(out_dir):
+    try:
+        with open(os.path.join(out_dir, MANIFEST)) as f:
+            return {entry['output']: entry for entry in json.load(f)['files']}
+    except (OSError, ValueError, KeyError):
+        return {}
+
+
+def write_manifest(out_dir, entries):
+    path = os.path.join(out_dir, MANIFEST)
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'files': sorted(entries.values(), key=lambda e: e['output'])},
+                  f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def convert_batch(paths, out_dir='gbtile_out', dither_mode='bayer', rotate='auto',
+                  align='center', workers=None, force=False):
+    """
+    Converts every image in paths on a process pool, skipping the ones whose
+    output is already up to date. The manifest is rewritten as results come
+    in, so an interrupted batch picks up where it stopped. Returns
+    (converted, skipped, failed) counts.
+    """
+    options = {'dither_mode': dither_mode, 'rotate': rotate, 'align': align}
+    os.makedirs(out_dir, exist_ok=True)
+    previous = load_manifest(out_dir)
+    entries = {}
+    todo = []
+    for src, dst in find_inputs(paths, out_dir):
+        if not force and up_to_date(src, dst, options, previous):
+            entries[dst] = previous[dst]
+        else:
+            todo.append((src, dst))
+    skipped = len(entries)
+    failed = 0
+    pending = 0
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(convert_file, src, dst, **options): src
+                   for src, dst in todo}
+        try:
+            for future in as_completed(futures):
+                src = futures[future]
+                try:
+                    entry = future.result()
+                except Exception as e:
+                    log.error(f'Could not convert {src}: {e!r}')
+                    failed += 1
+                    continue
+                entry['options'] = options
+                entries[entry['output']] = entry
+                log.info(f'{src} -> {entry["output"]} ({entry["pages"]:.1f} pages)')
+                pending += 1
+                if pending >= MANIFEST_EVERY:
+                    write_manifest(out_dir, entries)
+                    pending = 0
+        finally:
+            #also on ctrl-c, so what did finish isn't converted again
+            write_manifest(out_dir, entries)
+    return len(todo) - failed, skipped, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert images or folders of '
+                                     'images to gbtile data for printing')
+    parser.add_argument('inputs', nargs='+', help='image files or folders')
+    parser.add_argument('--out', default='gbtile_out', help='output folder')
+    parser.add_argument('--dither', default='bayer', choices=list(image.dither_factory.modes))
+    parser.add_argument('--rotate', default='auto',
+                        choices=['auto', 'portrait', 'landscape', 'none'])
+    parser.add_argument('--align', default='center', choices=['top', 'center', 'bottom'])
+    parser.add_argument('--workers', type=int, help='processes, all cores by default')
+    parser.add_argument('--force', action='store_true',
+                        help='convert even if the output is up to date')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    start = time.perf_counter()
+    try:
+        converted, skipped, failed = convert_batch(
+            args.inputs, args.out, dither_mode=args.dither, rotate=args.rotate,
+            align=args.align, workers=args.workers, force=args.force)
+    except ValueError as e:
+        parser.error(str(e))
+    print(f'{converted} converted, {skipped} up to date, {failed} failed '
+          f'in {time.perf_counter() - start:.1f} s')
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,894 @@
+import image
+import emulator
+import rle
+import async_emulator
+import capture
+import archive
+import printer
+import metrics
+import profiling
+
+import argparse
+import asyncio
+import json
+import logging
+import platform
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import math
+import multiprocessing
+import timeit
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from PIL import Image
+
+
+def make_gbtile(pages, seed=0):
+    """Random gbtile bytes, which is as good as any camera print for timing"""
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, 256, 640*pages, dtype=np.uint8).tobytes()
+
+
+def make_camera_gbtile(pages, seed=0):
+    """
+    gbtile bytes with flat areas and noisy patches, closer to a camera print
+    than random bytes when it comes to how well it compresses
+    """
+    rng = np.random.default_rng(seed)
+    flat = rng.integers(0, 4, (2*pages, 20), dtype=np.uint8)
+    twobit = np.repeat(np.repeat(flat, 8, axis=0), 8, axis=1)
+    noisy = rng.random((2*pages, 20)) < 0.3
+    noise = rng.integers(0, 4, twobit.shape, dtype=np.uint8)
+    mask = np.repeat(np.repeat(noisy, 8, axis=0), 8, axis=1)
+    twobit[mask] = noise[mask]
+    return image.twobit_to_gbtile(twobit)
+
+
+def make_print_packets(pages, seed=0, compressed=False):
+    """
+    Packets for a whole camera-style print the way a Game Boy sends them:
+    INIT, then up to 9 pages of DATA at a time, each batch closed with an
+    empty DATA, PRINT and STATUS polling. Only the last PRINT has a bottom
+    margin, so longer prints come out as one continuous image.
+    """
+    packets = [printer.make_packet(emulator.INIT)]
+    for first in range(0, pages, 9):
+        batch = range(first, min(first+9, pages))
+        for i in batch:
+            page = make_camera_gbtile(1, seed=seed+i)
+            if compressed:
+                page = rle.compress(page)
+            packets.append(printer.make_packet(emulator.DATA, page, compressed))
+        margin = 0x03 if batch[-1] == pages-1 else 0x00
+        packets += [printer.make_packet(emulator.DATA),
+                    printer.make_print_packet(bottom_margin=margin)]
+        packets += [printer.make_packet(emulator.STATUS)] * 3
+    return packets
+
+
+def make_print_lines(pages, seed=0, compressed=False):
+    """Hex lines for make_print_packets, as they come from the dongle"""
+    return [make_hex_line(packet).strip()
+            for packet in make_print_packets(pages, seed, compressed)]
+
+
+class FakeSerial:
+    """
+    Stands in for serial.Serial, handing out a canned stream in chunks the
+    size a USB serial adapter tends to deliver
+    """
+    def __init__(self, stream, chunk=64):
+        self.stream = stream
+        self.chunk = chunk
+        self.pos = 0
+        self.timeout = 0
+
+    @property
+    def in_waiting(self):
+        return min(self.chunk, len(self.stream) - self.pos)
+
+    def read(self, size=1):
+        data = self.stream[self.pos:self.pos+size]
+        self.pos += len(data)
+        return data
+
+
+class FakeDonglePort:
+    """
+    Stands in for serial.Serial during port discovery. Only dongle_port shows
+    the banner, and only after boot_time seconds, like an Arduino resetting
+    when the port is opened.
+    """
+    dongle_port = None
+    boot_time = 0.5
+    #every port opened so far, for the tests to check they all got closed
+    opened = []
+
+    def __init__(self, port, baudrate=9600, timeout=None):
+        self.port = port
+        self.timeout = timeout
+        self.start = time.monotonic()
+        self.sent = False
+        self.closed = False
+        FakeDonglePort.opened.append(self)
+
+    @property
+    def in_waiting(self):
+        return 0
+
+    def read(self, size=1):
+        booted = time.monotonic() - self.start >= self.boot_time
+        if self.port == self.dongle_port and booted and not self.sent:
+            self.sent = True
+            return b'GAMEBOY PRINTER Packet Capture V3.2.1\r\n'
+        time.sleep(self.timeout or 0)
+        return b''
+
+    def close(self):
+        self.closed = True
+
+
+def make_hex_line(packet):
+    return ' '.join(f'{x:02X}' for x in packet).encode() + b'\r\n'
+
+
+def legacy_get_line(serial, timeout=1):
+    """The original byte at a time reader"""
+    start = time.time()
+    serial_buffer = bytearray()
+    while True:
+        from_gb = serial.read()
+        if from_gb:
+            serial_buffer.append(int.from_bytes(from_gb, 'big'))
+            if from_gb == b'\n':
+                break
+        if time.time() - start > timeout:
+            break
+    return serial_buffer.strip()
+
+
+def legacy_parse_packet(line):
+    """
+    The original parse path, split and int() every token then slice and sum
+    the list. Returns the payload and whether the checksum matched.
+    """
+    data = [int(x, 16) for x in line.split(b' ')]
+    data_length = data[4] + data[5]*256
+    payload = data[6:6+data_length]
+    checksum = data[-4] + data[-3]*256
+    return bytes(payload), sum(data[2:-4])%(256**2) == checksum
+
+
+def legacy_decompress(comp_data):
+    """The original list based decompressor"""
+    raw_data = [0]*640
+    comp_offset = 0
+    raw_offset = 0
+    while comp_offset < len(comp_data):
+        command_byte = comp_data[comp_offset]
+        comp_offset += 1
+        if command_byte & 0x80: #compressed run
+            length = command_byte - 0x80 + 2
+            duped_byte = comp_data[comp_offset]
+            comp_offset += 1
+            raw_data[raw_offset:raw_offset+length] = [duped_byte]*length
+            raw_offset += length
+        else: #uncompressed run
+            length = command_byte + 1
+            unduped_data = comp_data[comp_offset:comp_offset+length]
+            comp_offset += length
+            raw_data[raw_offset:raw_offset+length] = unduped_data
+            raw_offset += length
+    return bytes(raw_data)
+
+
+def legacy_gbtile_to_twobit(gbtile_bytes):
+    """
+    The original row by row decoder, kept around to check the new one against
+    """
+    num_pages = len(gbtile_bytes)//640
+    twobit = np.empty((16*num_pages,160))
+
+    for s in range(num_pages*2):
+        strip_bytes = gbtile_bytes[320*s:320*(s+1)]
+        for t in range(20):
+            tile_bytes = strip_bytes[16*t:16*(t+1)]
+            for r in range(8):
+                row_bytes = tile_bytes[2*r:2*(r+1)]
+                low, high = row_bytes
+                mat_row = [(low>>i & 1) + 2*(high>>i & 1) for i in reversed(range(8))]
+                twobit[s*8+r,t*8:(t+1)*8] = mat_row
+
+    return twobit.astype(np.uint8)
+
+
+def legacy_twobit_to_gbtile(arr):
+    """
+    The original split and sum encoder, kept around to check the new one against
+    """
+    gbtile = b''
+    rows = arr.shape[0]
+    for strip in np.vsplit(arr,rows//8):
+        for tile in np.hsplit(strip,20):
+            tile_hex = b''
+            for row in tile:
+                low = bytes([sum([(x%2)*(2**(7-i)) for i,x in enumerate(row)])])
+                high = bytes([sum([(x//2)*(2**(7-i)) for i,x in enumerate(row)])])
+                tile_hex = tile_hex + low + high
+            gbtile = gbtile + tile_hex
+
+    return gbtile
+
+
+def legacy_bayer(image):
+    """The original float Bayer dither, rebuilding its threshold map each call"""
+    coeff = np.array([[ 0, 8, 2,10],
+                      [12, 4,14, 6],
+                      [ 3,11, 1, 9],
+                      [15, 7,13, 5]])
+    h,w = image.shape
+    num_tiles = tuple([math.ceil(x/4) for x in image.shape])
+    c = np.tile(coeff,num_tiles)[:h,:w]
+    image = image + 82*(c/16 - 1/2)
+    return 85 * np.round(image/85).astype(np.uint8)
+
+
+def reference_error_diffusion(image, diffusion):
+    """Plain pixel by pixel error diffusion, to check the wavefronts against"""
+    h, w = image.shape
+    buf = image.astype(np.int64).tolist()
+    for y in range(h):
+        for x in range(w):
+            value = buf[y][x]
+            quantized = 85 * min(max((value + 42) // 85, 0), 3)
+            buf[y][x] = quantized
+            error = value - quantized
+            for dy, dx, weight in diffusion.kernel:
+                if 0 <= y+dy < h and 0 <= x+dx < w:
+                    buf[y+dy][x+dx] += (error * weight + diffusion.half) >> diffusion.shift
+    return np.array(buf, dtype=np.uint8)
+
+
+def legacy_gray_resize(path):
+    """The original resize, a full LANCZOS straight from the source size"""
+    im = image.rotate_image(Image.open(path))
+    w, h = im.size
+    im = im.resize((160, int(160*h/w)), resample=Image.LANCZOS)
+    return image.to_gray(image.resize_image_to_160px(im))
+
+
+def proc_status_kib(field):
+    """A memory figure from /proc/self/status in KiB, None where there is none"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def measure_resize(legacy, path):
+    """
+    Seconds and peak RSS growth in bytes for one resize, run in a fresh
+    process. ru_maxrss can't be used here, a spawned child starts out with
+    the peak of the parent it was forked from, so on Linux the peak is reset
+    through clear_refs and read back as VmHWM.
+    """
+    func = legacy_gray_resize if legacy else image.gray_resize
+    before = proc_status_kib('VmRSS')
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        before = None
+    start = time.perf_counter()
+    func(path)
+    elapsed = time.perf_counter() - start
+    if before is None:
+        return elapsed, None
+    return elapsed, (proc_status_kib('VmHWM') - before) * 1024
+
+
+def legacy_render_rgb(pil_image, palette, scale):
+    """The original PIL resize and convert the preview did on every repaint"""
+    pil_image.putpalette(palette)
+    w, h = pil_image.size
+    resized_img = pil_image.resize((w*scale, h*scale), Image.NEAREST)
+    return resized_img.convert('RGB').tobytes()
+
+
+def best_time(func, *args, repeat=5):
+    """Best per-call time in seconds out of a few runs"""
+    timer = timeit.Timer(lambda: func(*args))
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number
+
+
+def compare(name, old, new, *args):
+    t_old = best_time(old, *args)
+    t_new = best_time(new, *args)
+    print(f'{name:<28} {t_old*1000:10.3f} ms {t_new*1000:10.3f} ms '
+          f'{t_old/t_new:8.1f}x')
+
+
+def bench_decode():
+    for pages in [1, 9, 100]:
+        gbtile = make_gbtile(pages)
+        compare(f'gbtile_to_twobit {pages:>3} pg', legacy_gbtile_to_twobit,
+                image.gbtile_to_twobit, gbtile)
+
+
+def bench_encode():
+    for pages in [1, 9, 100]:
+        twobit = image.gbtile_to_twobit(make_gbtile(pages))
+        compare(f'twobit_to_gbtile {pages:>3} pg', legacy_twobit_to_gbtile,
+                image.twobit_to_gbtile, twobit)
+
+
+def make_gray(pages, seed=0):
+    """A smooth gradient with noise on top, 160 wide and 16 rows per page"""
+    rng = np.random.default_rng(seed)
+    ramp = np.linspace(0, 255, 160)[None, :] * np.ones((16*pages, 1))
+    return np.clip(ramp + rng.normal(0, 24, ramp.shape), 0, 255).astype(np.uint8)
+
+
+def bench_dither():
+    for pages in [9, 100]:
+        gray = make_gray(pages)
+        compare(f'bayer {pages:>3} pg', legacy_bayer, image.bayer, gray)
+        for mode in image.dither_factory.modes:
+            t = best_time(image.dither, gray, mode, repeat=3)
+            print(f'dither {mode:<14} {pages:>3} pg              {t*1000:10.3f} ms')
+
+
+def bench_large_images(size=(6000, 4000)):
+    """Resize phone-camera sized photos, each run in its own process for RSS"""
+    rng = np.random.default_rng(0)
+    w, h = size
+    ramp = np.linspace(0, 255, w)[None, :, None] * np.ones((h, 1, 3))
+    pixels = np.clip(ramp + rng.normal(0, 16, (h, 1, 3)), 0, 255).astype(np.uint8)
+    photo = Image.fromarray(pixels, 'RGB')
+    spawn = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as tmp:
+        for ext in ['jpg', 'png']:
+            path = os.path.join(tmp, f'photo.{ext}')
+            photo.save(path)
+            results = []
+            for legacy in [True, False]:
+                with ProcessPoolExecutor(max_workers=1, mp_context=spawn) as pool:
+                    results.append(pool.submit(measure_resize, legacy, path).result())
+            (t_old, rss_old), (t_new, rss_new) = results
+            rss = 'peak RSS not available' if rss_old is None else \
+                f'peak RSS +{rss_old/2**20:.0f} MiB -> +{rss_new/2**20:.0f} MiB'
+            print(f'gray_resize {w}x{h} {ext:<5} {t_old*1000:10.1f} ms {t_new*1000:10.1f} ms '
+                  f'{t_old/t_new:8.1f}x   {rss}')
+
+
+def bench_preview_render():
+    palette = image.palette_list('gbgreen')
+    for pages in [9, 100]:
+        pil_image = image.gbtile_to_image(make_camera_gbtile(pages))
+        indices = np.asarray(pil_image)
+        for scale in [2, 3]:
+            compare(f'preview {pages:>3} pg {scale}x', legacy_render_rgb,
+                    lambda pil_image, palette, scale: image.indices_to_rgb(indices, palette, scale),
+                    pil_image, palette, scale)
+
+
+def bench_line_render(pages=100):
+    """
+    Time each DATA packet of a long print in convert_by_line mode. With the
+    incremental canvas the last packets should cost as much as the first.
+    """
+    packets = [emulator.GBPacket(printer.make_packet(emulator.DATA, make_gbtile(1, seed=i)))
+               for i in range(pages)]
+    emu = emulator.Emulator(convert_by_line=True)
+    fullimage = bytearray()
+    times_old = []
+    times_new = []
+    for i, packet in enumerate(packets):
+        if i % 9 == 0: #the printer only buffers 9 pages, so reset like a print would
+            emu.init_buffer()
+
+        start = time.perf_counter()
+        fullimage += bytes(packet.data)
+        image.gbtile_to_image(fullimage)
+        times_old.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        emu.handle_data(packet)
+        times_new.append(time.perf_counter() - start)
+
+    for name, times in [('whole image', times_old), ('canvas', times_new)]:
+        print(f'line render {name:<16} first 10 {np.mean(times[:10])*1000:8.3f} ms'
+              f'   last 10 {np.mean(times[-10:])*1000:8.3f} ms per packet')
+
+
+def bench_marathon(pages=1800):
+    """
+    Peak Python-heap memory over a long continuous print. Past spill_size the
+    print lives in a memory-mapped temp file, which tracemalloc doesn't see,
+    just like it doesn't count towards RSS once the OS pages it out.
+    """
+    packets = [emulator.GBPacket(packet) for packet in make_print_packets(pages)]
+    for mode in ['convert_by_line', 'convert_by_page']:
+        for spill_size in [2**40, 2**20]:
+            emu = emulator.Emulator(spill_size=spill_size, **{mode: True})
+            tracemalloc.start()
+            for i, packet in enumerate(packets):
+                emu.handle_packet(packet)
+                if i == len(packets) - 6: #just before the last PRINT
+                    spilled = emu._fullimage.spilled
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            name = 'no spill' if spill_size == 2**40 else f'spill {spill_size >> 20} MiB'
+            print(f'marathon {pages} pg {mode:<16} {name:<12} peak {peak/2**20:8.1f} MiB'
+                  f'   spilled {spilled}')
+
+
+def bench_get_line(lines=200):
+    stream = b''.join(make_hex_line(printer.make_packet(emulator.DATA, make_gbtile(1, seed=i)))
+                      for i in range(lines))
+
+    def read_old():
+        serial = FakeSerial(stream)
+        return [legacy_get_line(serial) for _ in range(lines)]
+
+    def read_new():
+        gbserial = emulator.GBSerial()
+        gbserial.serial = FakeSerial(stream)
+        return [gbserial.get_line() for _ in range(lines)]
+
+    t_old = best_time(read_old, repeat=3) / lines
+    t_new = best_time(read_new, repeat=3) / lines
+    print(f'get_line lines/sec          {1/t_old:10.0f}    {1/t_new:10.0f}    '
+          f'{t_old/t_new:8.1f}x')
+
+
+def bench_parse(lines=200):
+    recorded = [make_hex_line(printer.make_packet(emulator.DATA, make_gbtile(1, seed=i))).strip()
+                for i in range(lines)]
+    emu = emulator.Emulator()
+
+    def parse_old():
+        return [legacy_parse_packet(line) for line in recorded]
+
+    def parse_new():
+        packets = [emu.parse_line(line) for line in recorded]
+        return [(bytes(p.data), p.is_valid() == 'VALID') for p in packets]
+
+    t_old = best_time(parse_old, repeat=3) / lines
+    t_new = best_time(parse_new, repeat=3) / lines
+    print(f'parse_line packets/sec      {1/t_old:10.0f}    {1/t_new:10.0f}    '
+          f'{t_old/t_new:8.1f}x')
+
+
+def bench_rle(pages=100):
+    for name, gbtile in [('camera', make_camera_gbtile(pages)),
+                         ('random', make_gbtile(pages))]:
+        raw_pages = [gbtile[640*i:640*(i+1)] for i in range(pages)]
+        comp_pages = [rle.compress(page) for page in raw_pages]
+        out = bytearray(640)
+
+        def decode_old():
+            return [legacy_decompress(page) for page in comp_pages]
+
+        def decode_new():
+            return [bytes(rle.decompress(page, out)) for page in comp_pages]
+
+        def encode():
+            return [rle.compress(page) for page in raw_pages]
+
+        ratio = sum(map(len, comp_pages)) / len(gbtile)
+        t_old = best_time(decode_old, repeat=3)
+        t_new = best_time(decode_new, repeat=3)
+        t_enc = best_time(encode, repeat=3)
+        mb = len(gbtile) / 1e6
+        print(f'rle decode {name} MB/s        {mb/t_old:10.1f}    {mb/t_new:10.1f}    '
+              f'{t_old/t_new:8.1f}x')
+        print(f'rle encode {name} MB/s                      {mb/t_enc:10.1f}'
+              f'    ratio {ratio:.2f}')
+
+
+def bench_discovery(num_ports=40):
+    """
+    Find a dongle among many silent ports. The old loop slept 2 seconds on
+    every port in turn, so it would have taken about 2 s per port.
+    """
+    ports = [f'/dev/ttyFAKE{i}' for i in range(num_ports)]
+    FakeDonglePort.dongle_port = ports[-1]
+    emulator.GBSerial.serial_class = FakeDonglePort
+    emulator.GBSerial.last_port = None
+    last_port_file = emulator.GBSerial.last_port_file
+    emulator.GBSerial.last_port_file = None
+    try:
+        for name in ['first scan', 'last port cached']:
+            start = time.perf_counter()
+            emulator.GBSerial.find_dongle(ports)
+            elapsed = time.perf_counter() - start
+            print(f'discovery {num_ports} ports {name:<17} {2*num_ports:6d} s est '
+                  f'{elapsed:10.3f} s')
+    finally:
+        emulator.GBSerial.serial_class = None
+        emulator.GBSerial.last_port_file = last_port_file
+
+
+def bench_async(dongles=4, pages=9):
+    """
+    Several emulators sharing one event loop, each fed a full print from an
+    in-memory source
+    """
+    lines = [make_hex_line(printer.make_packet(emulator.DATA, make_gbtile(1, seed=i))).strip()
+             for i in range(pages)]
+
+    async def run_all():
+        async def consume(emu):
+            return [status async for _, status in emu.images()]
+
+        emus = []
+        for _ in range(dongles):
+            source = async_emulator.MemorySource(lines)
+            source.close()
+            emu = async_emulator.AsyncEmulator(convert_by_line=True)
+            await emu.init(source)
+            emus.append(emu)
+        return await asyncio.gather(*[consume(emu) for emu in emus])
+
+    t = best_time(lambda: asyncio.run(run_all()), repeat=3)
+    print(f'async {dongles} dongles packets/sec              {dongles*pages/t:10.0f}')
+
+
+def bench_replay(prints=20, pages=9):
+    """Record synthetic prints to a capture file and replay it at full speed"""
+    lines = []
+    for i in range(prints):
+        lines += make_print_lines(pages, seed=i*pages)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.gbcap')
+        writer = capture.CaptureWriter(path)
+        for line in lines:
+            writer.write(line)
+        writer.close()
+        ratio = os.path.getsize(path) / sum(len(line)+2 for line in lines)
+        for mode in ['convert_by_line', 'convert_by_page']:
+            packets, elapsed = capture.replay(path, **{mode: True})
+            print(f'replay {mode:<20} packets/sec {packets/elapsed:10.0f}'
+                  f'    capture size {ratio:.2f}x')
+
+
+def bench_send(pages=27):
+    """Drive a print through the send path into our own emulator"""
+    gbtile = make_camera_gbtile(pages)
+    for compress in [False, True]:
+        t = best_time(lambda: printer.loopback_print(gbtile, compress=compress), repeat=3)
+        kind = 'compressed' if compress else 'raw'
+        print(f'loopback send {kind:<11} pages/sec           {pages/t:10.0f}')
+
+
+def bench_metrics(pages=9):
+    """Time what the metrics bookkeeping costs next to handling a packet"""
+    lines = make_print_lines(pages, compressed=True)
+    emu = emulator.Emulator()
+    t_inc = best_time(lambda: metrics.packets.inc(label_value='DATA'))
+    t_observe = best_time(lambda: metrics.handle_seconds.observe(0.001, 'DATA'))
+    t_handle = best_time(lambda: [emu.handle_packet(emu.parse_line(line))
+                                  for line in lines], repeat=3) / len(lines)
+    #a packet increments one counter and observes one histogram
+    print(f'metrics cost per packet     {(t_inc+t_observe)*1e6:10.2f} us    '
+          f'{(t_inc+t_observe)/t_handle*100:5.1f}% of handling')
+
+
+def bench_profiling(pages=9):
+    """Time a print with the profiling hooks off, on, and with cProfile running"""
+    lines = make_print_lines(pages, compressed=True)
+
+    def handle():
+        emu = emulator.Emulator()
+        for line in lines:
+            emu.handle_packet(emu.parse_line(line))
+    t_off = best_time(handle, repeat=3)
+    with tempfile.TemporaryDirectory() as tmp:
+        for packets in [0, 10**9]:
+            profiling.start(tmp, profile_packets=packets)
+            t_on = best_time(handle, repeat=3)
+            profiling.stop()
+            kind = 'cProfile' if packets else 'spans'
+            print(f'profiling {kind:<8} packets/sec   {len(lines)/t_off:10.0f}    '
+                  f'{len(lines)/t_on:10.0f}    {t_off/t_on:8.2f}x')
+
+
+def bench_archive(prints=50, pages=9):
+    """
+    Store prints as PNGs and in an archive, then read a print back from the
+    archive and export it in another palette
+    """
+    gbtiles = [make_camera_gbtile(pages, seed=i) for i in range(prints)]
+    with tempfile.TemporaryDirectory() as tmp:
+        png_dir = os.path.join(tmp, 'png')
+        os.makedirs(png_dir)
+        start = time.perf_counter()
+        for gbtile in gbtiles:
+            image.write_png(image.gbtile_to_image(gbtile), png_dir, 'gbp')
+        t_png = time.perf_counter() - start
+        png_size = sum(entry.stat().st_size for entry in os.scandir(png_dir))
+
+        path = os.path.join(tmp, 'prints.gbarc')
+        with archive.PrintArchive(path) as arc:
+            start = time.perf_counter()
+            for gbtile in gbtiles:
+                arc.append(gbtile, palette='gray', port='/dev/ttyBENCH')
+            t_arc = time.perf_counter() - start
+        arc_size = os.path.getsize(path) + os.path.getsize(path + '.idx')
+
+        with archive.PrintArchive(path) as arc:
+            t_get = best_time(lambda: arc[prints//2])
+            t_export = best_time(lambda: arc[prints//2].image('gbgreen'), repeat=3)
+    print(f'store {prints} prints         {t_png*1000:10.1f} ms {t_arc*1000:10.1f} ms '
+          f'{t_png/t_arc:8.1f}x   {png_size/1024:.0f} KiB -> {arc_size/1024:.0f} KiB')
+    print(f'archive random access          {t_get*1e6:10.1f} us   '
+          f'export in another palette {t_export*1000:.2f} ms')
+
+
+def bench_thumbnails(prints=300, pages=27):
+    """
+    Scroll through the thumbnails of an archive of long prints, decoding
+    only the top of each print against decoding every print whole
+    """
+    palette = image.palette_list('gbgreen')
+    with tempfile.TemporaryDirectory() as tmp:
+        with archive.PrintArchive(os.path.join(tmp, 'prints.gbarc')) as arc:
+            for i in range(prints):
+                arc.append(make_camera_gbtile(pages, seed=i))
+
+            def whole():
+                for printed in arc:
+                    indices = np.asarray(printed.image())[:144:2, ::2]
+                    image.indices_to_rgb(indices, palette)
+
+            def thumbnails():
+                for printed in arc:
+                    image.thumbnail_rgb(printed.gbtile, palette)
+
+            t_old = best_time(whole, repeat=3)
+            t_new = best_time(thumbnails, repeat=3)
+    print(f'thumbnails {prints} prints       {t_old*1000:10.1f} ms {t_new*1000:10.1f} ms '
+          f'{t_old/t_new:8.1f}x')
+
+
+#seconds from starting the interpreter to ready, anything slower fails the suite
+STARTUP_BUDGET = {'daemon': 1.0, 'window': 3.0}
+STARTUP_SCRIPTS = {
+    'daemon': 'import daemon\ndaemon.CaptureDaemon()\n',
+    'window': 'import wx, window\napp = wx.App(False)\nframe = window.MainWindow()\n',
+}
+#reports peak RSS and which heavy modules really got loaded, not just lazily.
+#VmHWM starts over at exec, ru_maxrss keeps the peak of the benchmark it was
+#forked from, so it is only the fallback
+STARTUP_READY = """
+import resource, sys, types
+loaded = [name for name in ('numpy', 'PIL.Image', 'serial', 'wx', 'cProfile')
+          if type(sys.modules.get(name)) is types.ModuleType]
+try:
+    with open('/proc/self/status') as f:
+        peak = next(int(line.split()[1]) for line in f if line.startswith('VmHWM:'))
+except (OSError, StopIteration):
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print('ready', peak, *loaded, flush=True)
+"""
+#what each entry point may load before it is ready, checked by the tests
+HEAVY_MODULES = {'daemon': [], 'window': ['wx']}
+
+
+def time_startup(name, repeat=5):
+    """
+    Best time from launching a fresh interpreter until the entry point is
+    ready, its peak RSS in bytes and the heavy modules it loaded. None if it
+    can't start here, e.g. no wx or no display.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        proc = subprocess.Popen([sys.executable, '-c', STARTUP_SCRIPTS[name] + STARTUP_READY],
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), text=True)
+        line = proc.stdout.readline()
+        elapsed = time.perf_counter() - start
+        proc.communicate()
+        if not line.startswith('ready'):
+            return None
+        best = min(best, elapsed) if best else elapsed
+    _, rss, *loaded = line.split()
+    return best, int(rss)*1024, loaded
+
+
+def startup_results():
+    """Startup times in the same shape as measure, for the suite"""
+    results = {}
+    for name in STARTUP_SCRIPTS:
+        startup = time_startup(name)
+        if startup is None:
+            continue
+        seconds, rss, _ = startup
+        results[f'startup/{name}'] = {'seconds': seconds, 'per_sec': 1/seconds,
+                                      'unit': 'starts', 'peak_bytes': rss}
+    return results
+
+
+def over_budget(results):
+    return [name for name, result in results.items() if name.startswith('startup/')
+            and result['seconds'] > STARTUP_BUDGET[name.split('/')[1]]]
+
+
+def bench_startup():
+    results = startup_results()
+    for name in STARTUP_SCRIPTS:
+        result = results.get(f'startup/{name}')
+        if result is None:
+            print(f'startup {name:<8} can not start here, skipped')
+            continue
+        flag = ' OVER BUDGET' if over_budget({f'startup/{name}': result}) else ''
+        print(f'startup {name:<8} to ready {result["seconds"]*1000:10.1f} ms'
+              f'   budget {STARTUP_BUDGET[name]*1000:.0f} ms'
+              f'   peak RSS {result["peak_bytes"]/2**20:.0f} MiB{flag}')
+
+
+def peak_memory(func, *args):
+    """Peak bytes allocated during one call"""
+    tracemalloc.start()
+    try:
+        func(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def measure(func, *args, count=1, unit=None):
+    """
+    Time and peak memory for one operation. count is how many units (pages,
+    packets) a call handles, for the per second figure.
+    """
+    seconds = best_time(func, *args, repeat=3)
+    return {
+        'seconds': seconds,
+        'per_sec': count / seconds,
+        'unit': unit,
+        'peak_bytes': peak_memory(func, *args),
+    }
+
+
+def run_packets(packets, **emulator_kwargs):
+    emu = emulator.Emulator(**emulator_kwargs)
+    for packet in packets:
+        emu.handle_packet(emulator.GBPacket(packet))
+
+
+def suite():
+    """
+    Times every stage of the packet and image pipelines on synthetic camera
+    prints and returns the results keyed by benchmark name
+    """
+    logging.getLogger('emulator').setLevel(logging.WARNING)
+    results = {}
+    for pages in [1, 9, 100]:
+        gbtile = make_camera_gbtile(pages)
+        twobit = image.gbtile_to_twobit(gbtile)
+        gray = np.random.default_rng(pages).integers(0, 256, twobit.shape, dtype=np.uint8)
+        results[f'gbtile_to_twobit/{pages}pg'] = measure(
+            image.gbtile_to_twobit, gbtile, count=pages, unit='pages')
+        results[f'twobit_to_gbtile/{pages}pg'] = measure(
+            image.twobit_to_gbtile, twobit, count=pages, unit='pages')
+        results[f'gbtile_to_image/{pages}pg'] = measure(
+            image.gbtile_to_image, gbtile, count=pages, unit='pages')
+        for mode in image.dither_factory.modes:
+            results[f'dither_{mode}/{pages}pg'] = measure(
+                image.dither, gray, mode, count=pages, unit='pages')
+
+        for compressed in [False, True]:
+            kind = 'compressed' if compressed else 'raw'
+            packets = make_print_packets(pages, compressed=compressed)
+            lines = [make_hex_line(packet).strip() for packet in packets]
+            parser = emulator.Emulator()
+            results[f'parse_line_{kind}/{pages}pg'] = measure(
+                lambda: [parser.parse_line(line) for line in lines],
+                count=len(lines), unit='packets')
+            for mode in ['convert_by_line', 'convert_by_page']:
+                results[f'handle_packet_{kind}_{mode}/{pages}pg'] = measure(
+                    lambda: run_packets(packets, **{mode: True}),
+                    count=len(packets), unit='packets')
+
+        data_packets = [printer.make_packet(emulator.DATA,
+                                            rle.compress(make_camera_gbtile(1, seed=i)), True)
+                        for i in range(pages)]
+        out = bytearray(640)
+        results[f'decompress_data/{pages}pg'] = measure(
+            lambda: [emulator.GBPacket(packet).decompress_data(out)
+                     for packet in data_packets],
+            count=pages, unit='packets')
+    return results
+
+
+def report(results, baseline=None, threshold=0.10):
+    """
+    Print the results, next to a baseline if given. Returns the names that
+    got more than threshold slower than the baseline.
+    """
+    slower = []
+    print(f'{"benchmark":<44} {"time":>12} {"rate":>16} {"peak mem":>10} {"vs base":>9}')
+    for name, result in results.items():
+        line = (f'{name:<44} {result["seconds"]*1000:9.3f} ms '
+                f'{result["per_sec"]:9.0f} {result["unit"]+"/s":<6} '
+                f'{result["peak_bytes"]/1024:7.0f} KiB')
+        if baseline and name in baseline:
+            change = result['seconds'] / baseline[name]['seconds'] - 1
+            line += f' {change:+8.1%}'
+            if change > threshold:
+                line += ' SLOWER'
+                slower.append(name)
+        print(line)
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the packet and image pipelines')
+    parser.add_argument('mode', nargs='?', default='compare', choices=['compare', 'suite'],
+                        help='compare old and new implementations, or run the suite')
+    parser.add_argument('--save', help='write suite results to this JSON file')
+    parser.add_argument('--baseline', help='JSON file from an earlier --save to compare against')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='fraction slower than the baseline that counts as a regression')
+    args = parser.parse_args()
+
+    if args.mode == 'compare':
+        print(f'{"":<28} {"old":>13} {"new":>13} {"speedup":>9}')
+        bench_decode()
+        bench_encode()
+        bench_dither()
+        bench_large_images()
+        bench_preview_render()
+        bench_line_render()
+        bench_marathon()
+        bench_get_line()
+        bench_parse()
+        bench_rle()
+        bench_discovery()
+        bench_async()
+        bench_replay()
+        bench_send()
+        bench_archive()
+        bench_thumbnails()
+        bench_metrics()
+        bench_profiling()
+        bench_startup()
+        return
+
+    results = suite()
+    results.update(startup_results())
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+    slower = report(results, baseline, args.threshold)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(),
+                'numpy': np.__version__,
+                'machine': platform.machine(),
+                'results': results,
+            }, f, indent=2)
+    if slower:
+        raise SystemExit(f'{len(slower)} benchmarks got slower than the baseline')
+    over = over_budget(results)
+    if over:
+        raise SystemExit(f'Startup over budget: {", ".join(over)}')
+
+
+if __name__ == '__main__':
+    main()
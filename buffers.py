@@ -0,0 +1,111 @@
+import mmap
+import tempfile
+
+PAGE_SIZE = 640
+
+
+class PageBuffer:
+    """
+    The printer's own memory, room for a fixed number of pages allocated
+    once and reused for every print
+    """
+    def __init__(self, pages=9):
+        self._data = bytearray(PAGE_SIZE*pages)
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    @property
+    def capacity(self):
+        return len(self._data)
+
+    def append(self, data):
+        """
+        Copy data onto the end, or return False and copy nothing if it
+        would not fit
+        """
+        end = self._length + len(data)
+        if end > len(self._data):
+            return False
+        self._data[self._length:end] = data
+        self._length = end
+        return True
+
+    def clear(self):
+        self._length = 0
+
+    @property
+    def view(self):
+        """The bytes received so far, without copying them"""
+        return memoryview(self._data)[:self._length]
+
+
+class SpillBuffer:
+    """
+    Append-only bytes that grow in fixed chunks, and move to a memory-mapped
+    temporary file once they pass spill_size, so a marathon print is paged
+    out by the OS instead of piling up in RAM.
+
+    Growing or clearing never writes into memory handed out earlier through
+    view, so images made from it stay intact.
+    """
+    def __init__(self, chunk_size=64*1024, spill_size=4*2**20):
+        self.chunk_size = chunk_size
+        self.spill_size = spill_size
+        self.clear()
+
+    def __len__(self):
+        return self._length
+
+    @property
+    def spilled(self):
+        return self._file is not None
+
+    def clear(self):
+        self._release()
+        if getattr(self, '_file', None):
+            self._file.close()
+        self._file = None
+        self._data = bytearray(self.chunk_size)
+        self._length = 0
+
+    def _release(self):
+        data = getattr(self, '_data', None)
+        if isinstance(data, mmap.mmap):
+            try:
+                data.close()
+            except BufferError:
+                pass #an image still uses it, it closes once that is gone
+
+    def _grow(self, needed):
+        capacity = -(-needed // self.chunk_size) * self.chunk_size
+        if self._file is None and capacity <= self.spill_size:
+            data = bytearray(capacity)
+            data[:self._length] = memoryview(self._data)[:self._length]
+        else:
+            if self._file is None:
+                self._file = tempfile.TemporaryFile(prefix='gbp_')
+                self._file.write(memoryview(self._data)[:self._length])
+            self._file.truncate(capacity)
+            self._file.flush()
+            data = mmap.mmap(self._file.fileno(), capacity)
+        self._release()
+        self._data = data
+
+    def append(self, data):
+        data = memoryview(data)
+        if data.nbytes == 0:
+            #cast() refuses views with a zero in their shape, e.g. a band of no rows
+            return
+        data = data.cast('B')
+        end = self._length + len(data)
+        if end > len(self._data):
+            self._grow(end)
+        self._data[self._length:end] = data
+        self._length = end
+
+    @property
+    def view(self):
+        """Everything appended so far, without copying it"""
+        return memoryview(self._data)[:self._length]
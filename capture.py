@@ -0,0 +1,217 @@
+import emulator
+import metrics
+import profiling
+
+import argparse
+import logging
+import struct
+import time
+
+log = logging.getLogger(__name__)
+
+MAGIC = b'GBPCAP1\n'
+#seconds since the capture started, how the line is stored, its length
+RECORD = struct.Struct('<dBI')
+RAW = 0
+HEX_UPPER = 1
+HEX_LOWER = 2
+
+
+def pack_line(line):
+    """
+    Store packet lines as the bytes they spell out, which is a third of the
+    size, as long as they turn back into exactly the same text
+    """
+    try:
+        data = bytes.fromhex(line.decode('ascii'))
+    except ValueError:
+        return RAW, line
+    text = data.hex(' ').encode('ascii')
+    if text.upper() == line:
+        return HEX_UPPER, data
+    if text == line:
+        return HEX_LOWER, data
+    return RAW, line
+
+
+def unpack_line(kind, data):
+    if kind == RAW:
+        return bytes(data)
+    text = bytes(data).hex(' ').encode('ascii')
+    return text.upper() if kind == HEX_UPPER else text
+
+
+class CaptureWriter:
+    """Appends timestamped lines to a capture file"""
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'wb')
+        self._file.write(MAGIC)
+        self._start = time.monotonic()
+
+    def write(self, line, timestamp=None):
+        if timestamp is None:
+            timestamp = time.monotonic() - self._start
+        kind, data = pack_line(line)
+        self._file.write(RECORD.pack(timestamp, kind, len(data)))
+        self._file.write(data)
+
+    def close(self):
+        self._file.close()
+
+
+def read_capture(path):
+    """Yields (timestamp, line) for every line in a capture file"""
+    with open(path, 'rb') as f:
+        buf = f.read()
+    if not buf.startswith(MAGIC):
+        raise ValueError(f'{path} is not a capture file')
+    view = memoryview(buf)
+    offset = len(MAGIC)
+    while offset + RECORD.size <= len(buf):
+        timestamp, kind, length = RECORD.unpack_from(buf, offset)
+        offset += RECORD.size
+        if offset + length > len(buf):
+            log.warning(f'Capture {path} ends partway through a line')
+            break
+        yield timestamp, unpack_line(kind, view[offset:offset+length])
+        offset += length
+
+
+class RecordingSource:
+    """
+    Wraps a source, GBSerial by default, and tees every line it returns to a
+    capture file
+    """
+    def __init__(self, source=None, path=None):
+        self.source = source if source else emulator.GBSerial()
+        self.path = path if path else time.strftime('gbp_out/gbp_%Y%m%d_%H%M%S.gbcap')
+        self.writer = None
+
+    def init(self):
+        self.source.init()
+        if self.writer is None:
+            self.writer = CaptureWriter(self.path)
+        log.info(f'Recording to {self.path}')
+        return self
+
+    def get_line(self, timeout=1):
+        line = self.source.get_line(timeout)
+        if line:
+            self.writer.write(line)
+        return line
+
+    def shutdown(self):
+        self.source.shutdown()
+        self.writer.close()
+        self.writer = None
+
+
+class ReplaySource:
+    """
+    Plays a capture file back as a source, either with the original timing
+    (realtime, scaled by speed) or as fast as it can be read. Once the file
+    runs out, get_line behaves like an idle dongle and finished is set.
+    """
+    def __init__(self, path, realtime=False, speed=1.0):
+        self.path = path
+        self.realtime = realtime
+        self.speed = speed
+        self.finished = False
+        self._lines = None
+
+    def init(self):
+        self._lines = read_capture(self.path)
+        self._start = time.monotonic()
+        self.finished = False
+        return self
+
+    def get_line(self, timeout=1):
+        if not self.finished:
+            try:
+                timestamp, line = next(self._lines)
+            except StopIteration:
+                self.finished = True
+            else:
+                if self.realtime:
+                    wait = self._start + timestamp/self.speed - time.monotonic()
+                    if wait > 0:
+                        time.sleep(wait)
+                return line
+        if self.realtime:
+            time.sleep(timeout)
+        return b''
+
+    def shutdown(self):
+        self._lines = None
+
+
+def replay(path, **emulator_kwargs):
+    """
+    Run a capture through an Emulator as fast as possible and return the
+    number of packets and the seconds it took
+    """
+    source = ReplaySource(path)
+    emu = emulator.Emulator(**emulator_kwargs)
+    emu.init(source)
+    packets = 0
+    start = time.perf_counter()
+    while True:
+        line = emu.get_line()
+        if source.finished:
+            break
+        packet = emu.parse_line(line)
+        if packet:
+            emu.handle_packet(packet)
+            packets += 1
+    elapsed = time.perf_counter() - start
+    emu.shutdown()
+    return packets, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Record a printing session '
+                                     'from the dongle or replay one')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    record_parser = subparsers.add_parser('record')
+    record_parser.add_argument('path', nargs='?', help='capture file to write')
+    record_parser.add_argument('--port', help='dongle port instead of scanning')
+    record_parser.add_argument('--metrics', help='Prometheus text file to keep up to date')
+    replay_parser = subparsers.add_parser('replay')
+    replay_parser.add_argument('path', help='capture file to read')
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    profiling.start_from_env(out_dir=args.profile, profile_packets=args.profile_packets)
+    if args.command == 'record':
+        source = RecordingSource(emulator.GBSerial(args.port), args.path)
+        emu = emulator.Emulator(auto_save=True)
+        emu.init(source)
+        writer = None
+        if args.metrics:
+            writer = metrics.PrometheusFileWriter(args.metrics)
+            writer.start()
+        try:
+            emu.run_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            emu.shutdown()
+            if writer:
+                writer.stop()
+    else:
+        logging.getLogger('emulator').setLevel(logging.WARNING)
+        packets, elapsed = replay(args.path)
+        print(f'{packets} packets in {elapsed:.3f} s, '
+              f'{packets/max(elapsed, 1e-9):.0f} packets/sec')
+        stats = metrics.stats()
+        print(f'{stats["checksum_errors"]} checksum errors, '
+              f'{stats["magic_errors"]} bad magic bytes')
+        for step, hist in stats['convert'].items():
+            print(f'{step}: {hist["count"]} conversions, '
+                  f'{hist["sum"]*1000/max(hist["count"], 1):.2f} ms average')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+import archive
+import emulator
+import image
+import metrics
+import profiling
+
+import argparse
+import logging
+import os
+import signal
+import threading
+
+log = logging.getLogger(__name__)
+
+CONVERSIONS = ['print', 'page', 'line']
+#the print so far, for the page and line conversions
+PREVIEW_NAME = 'printing.png'
+
+
+class CaptureDaemon:
+    """
+    Receives prints from a dongle without any GUI and writes each completed
+    print to out_dir, or only adds it to archive if one is given. A lost
+    dongle is looked for again every retry seconds until stop() is called.
+
+    With the page or line conversion, the print so far is also kept in
+    PREVIEW_NAME in out_dir while it comes in, and removed once it is done.
+    """
+    def __init__(self, port=None, out_dir='gbp_out', palette='gray',
+                 conversion='print', retry=5, archive=None):
+        self.log = logging.getLogger('daemon')
+        self.port = port
+        self.out_dir = out_dir
+        self.retry = retry
+        self.archive = archive
+        self.preview = None if conversion == 'print' else os.path.join(out_dir, PREVIEW_NAME)
+        self.emulator = emulator.Emulator(palette=palette,
+                                          convert_by_page=conversion == 'page',
+                                          convert_by_line=conversion == 'line',
+                                          archive=archive)
+        self.prints = 0
+        self._stop = threading.Event()
+
+    def stop(self, *args):
+        """Finish the line being read and exit, usable as a signal handler"""
+        self.log.info('Stopping')
+        self._stop.set()
+
+    def connect(self):
+        """Find the dongle, returns False if stopped before it turned up"""
+        while not self._stop.is_set():
+            try:
+                self.emulator.init(emulator.GBSerial(self.port))
+                return True
+            except IOError as e:
+                self.log.warning(f'{e}, trying again in {self.retry} s')
+                self._stop.wait(self.retry)
+        return False
+
+    def serve(self):
+        """Handle packets until stopped or the dongle goes away"""
+        while not self._stop.is_set():
+            line = self.emulator.get_line()
+            packet = self.emulator.parse_line(line)
+            if not packet:
+                continue
+            ret = self.emulator.handle_packet(packet)
+            if not ret or ret[0] is None:
+                continue
+            if ret[1] == 'complete':
+                self.prints += 1
+                if self.archive is None:
+                    image.save_queue.submit(ret[0], self.out_dir)
+                self.log.info(f'Print {self.prints} received')
+                if self.preview:
+                    self.remove_preview()
+            elif self.preview:
+                self.write_preview(ret[0])
+
+    def write_preview(self, im):
+        """Replace the preview in one go, so a viewer never sees half of it"""
+        tmp = f'{self.preview}.tmp'
+        try:
+            im.save(tmp, 'PNG')
+            os.replace(tmp, self.preview)
+        except OSError as e:
+            #not worth dropping the dongle over, serve() treats OSError as lost
+            self.log.warning(f'Could not write {self.preview}: {e}')
+
+    def remove_preview(self):
+        try:
+            os.remove(self.preview)
+        except FileNotFoundError:
+            pass
+
+    def run(self):
+        if self.archive is None or self.preview:
+            os.makedirs(self.out_dir, exist_ok=True)
+        while self.connect():
+            try:
+                self.serve()
+            except IOError as e:
+                self.log.error(f'Lost the dongle: {e}')
+            finally:
+                try:
+                    self.emulator.shutdown()
+                except IOError:
+                    pass
+        image.save_queue.flush()
+        where = self.archive.path if self.archive is not None else self.out_dir
+        self.log.info(f'{self.prints} prints saved to {where}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Capture prints from a Game Boy '
+                                     'Printer dongle without the GUI')
+    parser.add_argument('--port', help='dongle port instead of scanning')
+    parser.add_argument('--out', default='gbp_out', help='output folder')
+    parser.add_argument('--palette', default='gray', choices=image.PALETTES)
+    parser.add_argument('--conversion', default='print', choices=CONVERSIONS,
+                        help='decode at the end of the print, or also keep '
+                             f'{PREVIEW_NAME} in the output folder up to date after '
+                             'every page or as every line arrives')
+    parser.add_argument('--archive', help='add prints to this archive file '
+                        'instead of saving PNGs')
+    parser.add_argument('--retry', type=float, default=5,
+                        help='seconds between looking for a missing dongle')
+    parser.add_argument('--metrics', help='Prometheus text file to keep up to date')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format='%(asctime)s %(name)s %(levelname)s %(message)s')
+    if not args.verbose:
+        logging.getLogger('emulator').setLevel(logging.WARNING)
+    profiling.start_from_env(out_dir=args.profile, profile_packets=args.profile_packets)
+
+    print_archive = archive.PrintArchive(args.archive) if args.archive else None
+    daemon = CaptureDaemon(args.port, args.out, args.palette, args.conversion, args.retry,
+                           print_archive)
+    signal.signal(signal.SIGINT, daemon.stop)
+    signal.signal(signal.SIGTERM, daemon.stop)
+    writer = None
+    if args.metrics:
+        writer = metrics.PrometheusFileWriter(args.metrics)
+        writer.start()
+    try:
+        daemon.run()
+    finally:
+        if writer:
+            writer.stop()
+        if print_archive:
+            print_archive.close()
+        profiling.stop()
+
+
+if __name__ == '__main__':
+    main()
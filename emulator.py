@@ -1,10 +1,15 @@
 import image
+import rle
+import buffers
+import metrics
 
-import serial
+import os
 import time
 import platform
 import logging
 import glob
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from collections import defaultdict
 
 CHECKSUM_ERROR = 0
@@ -35,6 +40,8 @@ DATA = 4
 BREAK = 8
 STATUS = 0xF
 
+MAX_PAGES = 9
+
 def unknown(): return 'UNKNOWN'
 p_type = defaultdict(unknown)
 p_type[0] = 'NULL'
@@ -47,33 +54,41 @@ p_type[0xF] = 'STATUS'
 log = logging.getLogger(__name__)
 
 class GBSerial:
+    #serial.Serial once a port is first opened, or a fake port class in tests
+    serial_class = None
+    banner = b'GAMEBOY PRINTER Packet Capture'
+    max_probes = 32
+    #the port the dongle was last found on, which gets probed first. That only
+    #changes anything when there are more ports than max_probes, since
+    #otherwise they all start at once. It is kept in last_port_file so it
+    #survives a restart, None turns that off.
+    last_port = None
+    last_port_file = os.path.join(os.path.expanduser('~'), '.gbprinter_port')
+
     def __init__(self, port=None):
         self.log = logging.getLogger('gbserial')
-        self.port = None
+        self.port = port
         self.serial = None
+        self._line_buffer = bytearray()
 
     def init(self):
         if self.serial:
             return
         if self.port is None:
-            good_ports = self.find_serial_ports()
+            good_ports = self.candidate_ports()
         else:
-            self.log.info(f'Printer on {port} you say?')
+            self.log.info(f'Printer on {self.port} you say?')
             good_ports = [self.port]
-        self.log.debug(f'Good ports are {",".join(good_ports)}')
-        for port in good_ports:
-            ret = self.test_port(port)
-            if ret:
-                self.log.info(f'Printer dongle found on {port}')
-                self.serial = ret
-                self.port = port
-                break
-        else:
+        self.log.debug(f'Candidate ports are {",".join(good_ports)}')
+        found = self.find_dongle(good_ports)
+        if found is None:
             raise IOError(f'Printer dongle not found on ports {",".join(good_ports)}')
+        self.port, self.serial = found
+        self.log.info(f'Printer dongle found on {self.port}')
         return self
 
     @staticmethod
-    def find_serial_ports():
+    def candidate_ports():
         opsys = platform.system()
         if opsys == 'Windows':
             ports = ['COM%s' % (i + 1) for i in range(2,256)]
@@ -84,53 +99,150 @@ class GBSerial:
         else:
             raise EnvironmentError('Not Windows, Mac, or Linux, dunno ' \
                                    'where your serial ports would be')
-        good_ports = []
-        for port in ports:
+        return ports
+
+    @classmethod
+    def open_port(cls, port, **kwargs):
+        if cls.serial_class is None:
+            import serial #pyserial is only loaded once a dongle is looked for
+            GBSerial.serial_class = serial.Serial
+        return cls.serial_class(port, **kwargs)
+
+    @classmethod
+    def load_last_port(cls):
+        if cls.last_port is None and cls.last_port_file:
             try:
-                s = serial.Serial(port)
-                s.close()
-                good_ports.append(port)
-            except (OSError, serial.SerialException):
+                with open(cls.last_port_file) as f:
+                    cls.last_port = f.read().strip() or None
+            except OSError:
                 pass
-        return good_ports
+        return cls.last_port
 
-    @staticmethod
-    def test_port(port):
-        test_serial = serial.Serial(port, baudrate=115200, timeout=0)
-        log.info(f'Checking port {port}')
-        time.sleep(2)
-        response = test_serial.read(9999)
-        if b'GAMEBOY PRINTER Packet Capture' in response:
-            return test_serial
-        else:
-            test_serial.close()
+    @classmethod
+    def save_last_port(cls, port):
+        cls.last_port = port
+        if not cls.last_port_file:
+            return
+        try:
+            with open(cls.last_port_file, 'w') as f:
+                f.write(port)
+        except OSError as e:
+            log.debug(f'Could not remember the dongle port in {cls.last_port_file}: {e}')
+
+    @classmethod
+    def find_dongle(cls, ports, timeout=3):
+        """
+        Probe every port at once and return (port, serial) for the first one
+        that shows the dongle banner, or None. The other probes are told to
+        stop as soon as it is found.
+        """
+        last_port = cls.load_last_port()
+        ports = sorted(ports, key=lambda port: port != last_port)
+        if not ports:
             return None
+        stop = threading.Event()
+        found = None
+        with ThreadPoolExecutor(max_workers=min(len(ports), cls.max_probes)) as pool:
+            futures = {pool.submit(cls.test_port, port, timeout, stop): port
+                       for port in ports}
+            for future in as_completed(futures):
+                test_serial = future.result()
+                if test_serial is None:
+                    continue
+                if found is None:
+                    found = futures[future], test_serial
+                    stop.set()
+                else:
+                    test_serial.close()
+        if found and found[0] != last_port:
+            cls.save_last_port(found[0])
+        return found
+
+    @classmethod
+    def find_dongles(cls, ports, timeout=3):
+        """
+        Probe every port at once and return (port, serial) for each one that
+        shows the dongle banner
+        """
+        ports = list(ports)
+        if not ports:
+            return []
+        with ThreadPoolExecutor(max_workers=min(len(ports), cls.max_probes)) as pool:
+            results = list(pool.map(lambda port: cls.test_port(port, timeout), ports))
+        return [(port, s) for port, s in zip(ports, results) if s]
+
+    @classmethod
+    def test_port(cls, port, timeout=3, stop=None):
+        """
+        Open a port and wait up to timeout seconds for the dongle banner.
+        Returns the open serial object if it shows up, otherwise None.
+        """
+        if stop is not None and stop.is_set():
+            return None
+        try:
+            test_serial = cls.open_port(port, baudrate=115200, timeout=0.1)
+        except OSError:
+            return None
+        log.info(f'Checking port {port}')
+        deadline = time.monotonic() + timeout
+        response = bytearray()
+        try:
+            while time.monotonic() < deadline:
+                if stop is not None and stop.is_set():
+                    break
+                response += test_serial.read(max(1, test_serial.in_waiting))
+                if cls.banner in response:
+                    return test_serial
+        except OSError:
+            pass
+        test_serial.close()
+        return None
 
     def get_line(self, timeout=1):
-        start = time.time()
-        serial_buffer = bytearray()
+        """
+        Return the next full line from the dongle, or an empty bytestring if
+        none arrives within the timeout. Whatever was read past the end of the
+        line is kept for the next call.
+        """
+        deadline = time.monotonic() + timeout
+        searched = 0
         while True:
-            from_gb = self.serial.read()
-            if from_gb:
-                serial_buffer.append(int.from_bytes(from_gb, 'big'))
-                if from_gb == b'\n':
-                    log.debug('Line received from serial')
-                    break
-            if time.time() - start > timeout:
+            end = self._line_buffer.find(b'\n', searched)
+            if end >= 0:
+                line = bytes(self._line_buffer[:end+1])
+                del self._line_buffer[:end+1]
+                metrics.serial_lines.inc()
+                log.debug('Line received from serial')
+                return line.strip()
+            searched = len(self._line_buffer)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                metrics.serial_timeouts.inc()
                 log.debug('Timeout from serial')
-                break
-        return serial_buffer.strip()
+                return b''
+            #wait up to the port's own short read timeout for the first byte, then
+            #take everything that has arrived, the deadline is kept by this loop
+            chunk = self.serial.read(max(1, self.serial.in_waiting))
+            metrics.serial_bytes.inc(len(chunk))
+            self._line_buffer += chunk
 
     def shutdown(self):
         self.serial.close()
+        self._line_buffer.clear()
 
 class Emulator:
         def __init__(self, port=None, palette=image.PALETTES['gray'], 
                      convert_by_page=False, convert_by_line=False,
-                     clear_after_print=True, auto_save=False):
+                     clear_after_print=True, auto_save=False, spill_size=4*2**20,
+                     archive=None):
             self.log = logging.getLogger('Emulator')
             self.palette = palette
+            #the printer holds 9 pages, a whole print can go on for much longer
+            self._buffer = buffers.PageBuffer(MAX_PAGES)
             self.init_buffer()
+            self._fullimage = buffers.SpillBuffer(spill_size=spill_size)
+            self._rle_buffer = bytearray(rle.PAGE_SIZE)
+            self.canvas = image.TwobitCanvas(spill_size=spill_size)
             self.running = False
             self.convert_by_page = convert_by_page
             self.convert_by_line = convert_by_line
@@ -138,22 +250,31 @@ class Emulator:
                 self.convert_by_page = False
             self.clear_after_print = clear_after_print
             self.auto_save = auto_save
+            #a PrintArchive every complete print is added to
+            self.archive = archive
+            self.source = None
 
         def init(self, source=None):
             self.log.debug('Begin to init')          
             self.source = source if source else GBSerial()
             self.source.init()
-            self._fullimage = bytearray()
-            self.running = True
+            self.reset()
             self.log.debug('Emulator is init')
 
+        def reset(self):
+            """Forget any partial print and mark the emulator as running"""
+            self._fullimage.clear()
+            self.canvas.clear()
+            self.running = True
+
         def shutdown(self):
             self.source.shutdown()
             self.running = False
+            image.save_queue.flush()
 
         def init_buffer(self):
             self._status = b'\x00'
-            self._buffer = bytearray()
+            self._buffer.clear()
             self.log.debug('Buffer is init!')
             # self._fullimage = bytearray()
 
@@ -164,6 +285,10 @@ class Emulator:
         @property
         def status_text(self):
             return [status_text[i] for i in range(8)if self._status[0]>>i & 0x01]
+
+        @property
+        def status_byte(self):
+            return self._status[0]
         
         @property
         def state(self):
@@ -203,20 +328,45 @@ class Emulator:
         def parse_line(self, data):
             # log.debug('Full line from serial:')
             # log.debug(data.decode('utf-8'))
-            if not data.startswith(b'88 33 '):
+            received = time.perf_counter()
+            #a header with one magic byte wrong still goes to GBPacket, so it is
+            #counted as bad magic instead of disappearing with the non packet lines
+            if not (data[:3] == b'88 ' or data[2:6] == b' 33 '):
+                if data:
+                    metrics.parse_failures.inc(label_value='not_a_packet')
                 log.debug('Not a proper packet')
                 return
-            data_split = data.split(b' ')
-            data_hex = [int(x, 16) for x in data_split]
+            try:
+                data_hex = bytes.fromhex(data.decode('ascii'))
+            except ValueError:
+                metrics.parse_failures.inc(label_value='bad_hex')
+                log.debug('Packet is not valid hex')
+                return
+            if len(data_hex) < 10:
+                metrics.parse_failures.inc(label_value='too_short')
+                log.debug('Packet is too short')
+                return
             p = GBPacket(data_hex)
+            p.received = received
             return p
 
         def handle_packet(self, packet):
             log.info(f'Received {packet}')
-            if packet.is_valid() != 'VALID':
-                log.info(f'Packet is invalid: {packet.is_valid()}')
+            valid = packet.is_valid()
+            if valid != 'VALID':
+                metrics.packet_errors.inc(label_value=valid)
+                log.info(f'Packet is invalid: {valid}')
                 return  
 
+            command = packet.command_text
+            metrics.packets.inc(label_value=command)
+            with metrics.handle_seconds.time(command):
+                ret = self.dispatch_packet(packet)
+            if ret and ret[0] is not None and packet.received is not None:
+                metrics.read_to_image_seconds.observe(time.perf_counter() - packet.received)
+            return ret
+
+        def dispatch_packet(self, packet):
             if packet.command == INIT:
                 self.handle_init(packet)
             elif packet.command == PRINT:
@@ -243,18 +393,26 @@ class Emulator:
             self.set_status(UNPROCESSED_DATA, False)
             end_margin = packet.data[1] % 16
             if not self.convert_by_line: #if it is, adding the buffer is handled in data command
-                self._fullimage += self._buffer
+                self._fullimage.append(self._buffer.view)
             if end_margin != 0:
                 log.info('Full image received!')
-                ret = image.gbtile_to_image(self._fullimage, palette=self.palette, save=self.auto_save)
-                self._fullimage = bytearray()
+                #a PRINT with nothing before it only feeds paper, there is no print to keep
+                if self.archive is not None and len(self._fullimage):
+                    self.archive.append(self._fullimage.view, palette=self.palette,
+                                        port=getattr(self.source, 'port', None))
+                if self.convert_by_line: #every band is already on the canvas
+                    ret = self.canvas.image(palette=self.palette, save=self.auto_save)
+                else:
+                    ret = image.gbtile_to_image(self._fullimage.view, palette=self.palette, save=self.auto_save)
+                self._fullimage.clear()
+                self.canvas.clear()
                 return ret, 'complete'
 
             else:
                 log.info('Page received!')
                 if self.convert_by_page:
                     log.info('Converting as requested!')
-                    ret = image.gbtile_to_image(self._fullimage, palette=self.palette, save=self.auto_save)
+                    ret = image.gbtile_to_image(self._fullimage.view, palette=self.palette, save=self.auto_save)
                     return ret, 'partial'
 
         def handle_data(self, packet):
@@ -262,18 +420,27 @@ class Emulator:
                 ret = None
                 if len(packet.data) == 0:
                     pass
-                elif self.pages >= 9:
+                elif self.pages >= MAX_PAGES:
                     log.warning("Buffer full, data packet rejected")
                     self.set_status(PACKET_ERROR)
                 else:
-                    if packet.compressed:
-                        packet.decompress_data()
-                    data = packet.data
-                    self._buffer += bytes(data)
-                    if self.convert_by_line:
-                        self._fullimage += bytes(data)
-                        ret = image.gbtile_to_image(self._fullimage, palette=self.palette, save=self.auto_save)
-                    self.set_status(UNPROCESSED_DATA)
+                    try:
+                        if packet.compressed:
+                            packet.decompress_data(self._rle_buffer)
+                    except ValueError as e:
+                        log.warning(f'Bad compressed data, data packet rejected: {e}')
+                        self.set_status(PACKET_ERROR)
+                    else:
+                        data = packet.data
+                        if not self._buffer.append(data):
+                            log.warning("Buffer full, data packet rejected")
+                            self.set_status(PACKET_ERROR)
+                        else:
+                            if self.convert_by_line:
+                                self._fullimage.append(data)
+                                self.canvas.append(data)
+                                ret = self.canvas.image(palette=self.palette, save=self.auto_save)
+                            self.set_status(UNPROCESSED_DATA)
                 log.debug('Number of pages in buffer: {}'.format(self.pages))
                 log.debug('Number of bytes in buffer: {}'.format(len(self._buffer)))
                 return ret, 'partial'
@@ -294,7 +461,15 @@ class Emulator:
 
 
 class GBPacket:
+    __slots__ = ('raw_data', 'magic', 'command', 'compressed', 'data_length',
+                 'data', 'checksum', 'response', '_status', 'valid', 'calc_sum',
+                 'received')
+
     def __init__(self, data):
+        #every field is a slice of the one buffer, nothing is copied
+        if not isinstance(data, (bytes, bytearray, memoryview)):
+            data = bytes(data)
+        data = memoryview(data)
         self.raw_data = data
         self.magic = data[0:2]
         self.command = data[2]
@@ -306,6 +481,8 @@ class GBPacket:
         self._status = data[-1]
         self.valid = None
         self.calc_sum = None
+        #perf_counter time the line was parsed, for latency metrics
+        self.received = None
 
     def is_valid(self):
         if self.valid is None:
@@ -313,7 +490,7 @@ class GBPacket:
         return self.valid
 
     def _check_validity(self):
-        if self.magic != [0x88, 0x33]:
+        if self.magic != b'\x88\x33':
             return 'BAD_MAGIC_BYTES'
         if self.command_text == 'UNKNOWN':
             return 'BAD_COMMAND'
@@ -338,28 +515,12 @@ class GBPacket:
     # def decompress_data(self):
     #     return self.data
 
-    def decompress_data(self):
-        comp_data = self.data
-        len_comp = len(comp_data)
-        raw_data = [0]*640
-        comp_offset = 0
-        raw_offset = 0
-        while comp_offset < len(comp_data):
-            command_byte = comp_data[comp_offset]
-            comp_offset += 1
-            if command_byte & 0x80: #compressed run
-                length = command_byte - 0x80 + 2
-                duped_byte = comp_data[comp_offset]
-                comp_offset += 1
-                raw_data[raw_offset:raw_offset+length] = [duped_byte]*length
-                raw_offset += length
-            else: #uncompressed run
-                length = command_byte + 1
-                unduped_data = comp_data[comp_offset:comp_offset+length]
-                comp_offset += length
-                raw_data[raw_offset:raw_offset+length] = unduped_data
-                raw_offset += length
-        self.data = raw_data
+    def decompress_data(self, out=None):
+        """
+        Expand the compressed payload, into out if a reusable buffer is given.
+        Raises ValueError on malformed data.
+        """
+        self.data = rle.decompress(self.data, out)
         self.compressed = False
 
     def __str__(self):
@@ -368,4 +529,4 @@ class GBPacket:
                f'data_length={self.data_length})'
 
     def __repr__(self):
-        return f'GBPacket({self.raw_data})'
\ No newline at end of file
+        return f'GBPacket({list(self.raw_data)})'
\ No newline at end of file
@@ -0,0 +1,194 @@
+import emulator
+import image
+import async_emulator
+import metrics
+import profiling
+
+import argparse
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+#threads beyond the one each dongle keeps busy reading
+EXECUTOR_HEADROOM = 4
+
+
+class PortStats:
+    """Running totals for one dongle, plus rates since the last report"""
+    def __init__(self):
+        self.packets = 0
+        self.bytes = 0
+        self.prints = 0
+        self.errors = 0
+        self.started = time.monotonic()
+        self._last_time = self.started
+        self._last_packets = 0
+        self._last_bytes = 0
+
+    def add_packet(self, packet):
+        self.packets += 1
+        self.bytes += len(packet.raw_data)
+        if packet.is_valid() != 'VALID':
+            self.errors += 1
+
+    def rates(self):
+        """Packets/sec and bytes/sec since the previous call"""
+        now = time.monotonic()
+        elapsed = max(now - self._last_time, 1e-9)
+        packet_rate = (self.packets - self._last_packets) / elapsed
+        byte_rate = (self.bytes - self._last_bytes) / elapsed
+        self._last_time = now
+        self._last_packets = self.packets
+        self._last_bytes = self.bytes
+        return packet_rate, byte_rate
+
+    def as_dict(self):
+        return {
+            'packets': self.packets,
+            'bytes': self.bytes,
+            'prints': self.prints,
+            'errors': self.errors,
+            'uptime': time.monotonic() - self.started,
+        }
+
+
+class PrintFarm:
+    """
+    One Emulator per attached dongle, all served by one event loop. Serial
+    reads block on a bounded thread pool with a real timeout, so an idle
+    dongle costs nothing but a parked thread while it waits.
+    """
+    def __init__(self, out_dir='gbp_out', max_workers=8, palette='gray',
+                 convert_by_page=False, convert_by_line=False):
+        self.log = logging.getLogger('farm')
+        self.out_dir = out_dir
+        self.max_workers = max_workers
+        self.emulator_kwargs = dict(palette=palette,
+                                    convert_by_page=convert_by_page,
+                                    convert_by_line=convert_by_line)
+        self.emulators = {}
+        self.stats = {}
+
+    def port_dir(self, port):
+        """Output folder for a port, e.g. gbp_out/ttyUSB0"""
+        return os.path.join(self.out_dir, os.path.basename(port))
+
+    def discover(self, ports=None):
+        """
+        Find every port with a dongle on it and get an emulator ready for
+        each. Returns the list of ports.
+        """
+        if ports is None:
+            ports = emulator.GBSerial.candidate_ports()
+        for port, ser in emulator.GBSerial.find_dongles(ports):
+            gbserial = emulator.GBSerial(port)
+            gbserial.serial = ser
+            self.attach(port, async_emulator.ThreadedSource(gbserial))
+        return list(self.emulators)
+
+    def attach(self, port, source):
+        """Add an emulator reading from source under the name port"""
+        self.log.info(f'Attaching emulator to {port}')
+        os.makedirs(self.port_dir(port), exist_ok=True)
+        emu = async_emulator.AsyncEmulator(**self.emulator_kwargs)
+        self.emulators[port] = emu, source
+        self.stats[port] = PortStats()
+
+    def pool_size(self):
+        """
+        Threads for the executor. Every dongle keeps one parked in a blocking
+        read, so fewer than that would leave some dongles unread until another
+        one times out, and the rest is for shutdowns and saves.
+        """
+        needed = len(self.emulators) + EXECUTOR_HEADROOM
+        if self.max_workers < needed:
+            self.log.warning(f'{self.max_workers} workers are not enough for '
+                             f'{len(self.emulators)} dongles, using {needed}')
+        return max(self.max_workers, needed)
+
+    def snapshot(self):
+        """Per-port totals, keyed by port"""
+        return {port: stats.as_dict() for port, stats in self.stats.items()}
+
+    async def serve_port(self, port):
+        emu, source = self.emulators[port]
+        stats = self.stats[port]
+        await emu.init(source)
+        try:
+            async for packet in emu.packets():
+                stats.add_packet(packet)
+                ret = emu.emulator.handle_packet(packet)
+                if ret and ret[0] is not None and ret[1] == 'complete':
+                    stats.prints += 1
+                    image.save_image(ret[0], self.port_dir(port))
+        finally:
+            await emu.shutdown()
+
+    async def report(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            for port, stats in self.stats.items():
+                packet_rate, byte_rate = stats.rates()
+                self.log.info(f'{port}: {packet_rate:.1f} packets/s, '
+                              f'{byte_rate/1024:.1f} KiB/s, '
+                              f'{stats.prints} prints, {stats.errors} bad packets')
+
+    async def run(self, report_interval=10):
+        """Serve every attached dongle until they have all shut down"""
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=self.pool_size()))
+        reporter = asyncio.create_task(self.report(report_interval))
+        try:
+            results = await asyncio.gather(
+                *[self.serve_port(port) for port in self.emulators],
+                return_exceptions=True)
+            for port, result in zip(self.emulators, results):
+                if isinstance(result, Exception):
+                    self.log.error(f'{port} stopped: {result!r}')
+        finally:
+            reporter.cancel()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Capture prints from every '
+                                     'attached Game Boy Printer dongle')
+    parser.add_argument('--out', default='gbp_out',
+                        help='output folder, each port gets a subfolder')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='threads for serial reads, raised to one per dongle '
+                             'plus a few spare if lower')
+    parser.add_argument('--palette', default='gray', choices=image.PALETTES)
+    parser.add_argument('--report', type=float, default=10,
+                        help='seconds between throughput reports')
+    parser.add_argument('--metrics', help='Prometheus text file to keep up to date')
+    parser.add_argument('--metrics-interval', type=float, default=15,
+                        help='seconds between metrics file writes')
+    parser.add_argument('ports', nargs='*', help='ports to use instead of scanning')
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    profiling.start_from_env(out_dir=args.profile, profile_packets=args.profile_packets)
+    farm = PrintFarm(out_dir=args.out, max_workers=args.workers,
+                     palette=args.palette)
+    if not farm.discover(args.ports or None):
+        raise SystemExit('No printer dongles found')
+    writer = None
+    if args.metrics:
+        writer = metrics.PrometheusFileWriter(args.metrics, args.metrics_interval)
+        writer.start()
+    try:
+        asyncio.run(farm.run(args.report))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if writer:
+            writer.stop()
+
+
+if __name__ == '__main__':
+    main()
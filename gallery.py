@@ -0,0 +1,105 @@
+import wx
+import time
+import logging
+from collections import OrderedDict
+
+import image
+
+log = logging.getLogger(__name__)
+
+#thumbnails show the top of a print, one Game Boy screen, at half size
+THUMB_ROWS = 144
+THUMB_SHRINK = 2
+
+
+class BitmapCache:
+    """
+    Bitmaps by key, least recently used dropped first once their pixel data
+    adds up to more than max_bytes
+    """
+    def __init__(self, max_bytes=16*2**20):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items = OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        item = self._items.get(key)
+        if item is None:
+            return None
+        self._items.move_to_end(key)
+        return item[0]
+
+    def put(self, key, bitmap, size):
+        old = self._items.pop(key, None)
+        if old is not None:
+            self.size -= old[1]
+        self._items[key] = bitmap, size
+        self.size += size
+        while self.size > self.max_bytes and len(self._items) > 1:
+            _, (_, dropped) = self._items.popitem(last=False)
+            self.size -= dropped
+
+    def clear(self):
+        self._items.clear()
+        self.size = 0
+
+
+class GalleryList(wx.VListBox):
+    """
+    Every print in an archive, oldest first. Rows are only drawn when they
+    are scrolled into view, so a print's thumbnail is decoded from its 2-bit
+    data the first time it is seen and then comes from the cache.
+    """
+    def __init__(self, parent, archive, palette=None, cache_bytes=16*2**20,
+                 size=wx.DefaultSize):
+        wx.VListBox.__init__(self, parent, wx.ID_ANY, size=size, style=wx.BORDER_SUNKEN)
+        self.archive = archive
+        self.palette = list(palette or image.palette_list('gray'))
+        self.cache = BitmapCache(cache_bytes)
+        self.row_height = THUMB_ROWS // THUMB_SHRINK + 8
+        self.SetItemCount(len(archive))
+
+    def refresh(self):
+        """Pick up prints added to the archive and scroll to the newest one"""
+        count = len(self.archive)
+        if count != self.GetItemCount():
+            self.SetItemCount(count)
+            self.ScrollToRow(count - 1)
+        self.Refresh()
+
+    def set_palette(self, palette):
+        if list(palette) == self.palette:
+            return
+        self.palette = list(palette)
+        self.Refresh()
+
+    def thumbnail(self, number):
+        key = (number, tuple(self.palette))
+        bitmap = self.cache.get(key)
+        if bitmap is None:
+            data, w, h = image.thumbnail_rgb(self.archive[number].gbtile, self.palette,
+                                             THUMB_ROWS, THUMB_SHRINK)
+            wx_img = wx.Image(w, h)
+            wx_img.SetData(data)
+            bitmap = wx_img.ConvertToBitmap()
+            self.cache.put(key, bitmap, len(data))
+        return bitmap
+
+    def OnMeasureItem(self, n):
+        return self.row_height
+
+    def OnDrawItem(self, dc, rect, n):
+        printed = self.archive[n]
+        bitmap = self.thumbnail(n)
+        dc.DrawBitmap(bitmap, rect.x + 4, rect.y + 4)
+        colour = wx.SYS_COLOUR_HIGHLIGHTTEXT if self.IsSelected(n) else wx.SYS_COLOUR_WINDOWTEXT
+        dc.SetTextForeground(wx.SystemSettings.GetColour(colour))
+        x = rect.x + 160 // THUMB_SHRINK + 12
+        when = time.localtime(printed.timestamp)
+        dc.DrawText(f'#{n + 1}', x, rect.y + 6)
+        dc.DrawText(time.strftime('%Y-%m-%d', when), x, rect.y + 24)
+        dc.DrawText(time.strftime('%H:%M:%S', when), x, rect.y + 42)
+        dc.DrawText(f'{printed.pages} pages' if printed.pages else 'empty', x, rect.y + 60)
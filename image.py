@@ -1,7 +1,22 @@
-from PIL import Image
+import buffers
+import lazy
+import metrics
 import time
-import numpy as np
 import math
+import os
+import atexit
+import itertools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import cached_property, lru_cache
+from collections import OrderedDict
+
+#loaded on the first conversion, not when the module is imported
+np = lazy.lazy_import('numpy')
+Image = lazy.lazy_import('PIL.Image')
+
+log = logging.getLogger(__name__)
 
 
 def gray_resize(in_image, rotate='auto', align='center'):
@@ -10,21 +25,41 @@ def gray_resize(in_image, rotate='auto', align='center'):
     pixels wide, optionally rotating in the process to be larger, and converts
     to grayscale     
     """
-    image = load_image(in_image)
+    image = load_image(in_image, draft_size=(PRESHRINK_SIZE, PRESHRINK_SIZE))
+    image = preshrink(image)
     image = rotate_image(image, rotate)
     image = resize_image_to_160px(image, align)
-    return to_gray(image_new)
+    return to_gray(image)
 
 
-def load_image(in_image):
-    """Get an image from a few different sources."""
+#twice the final width, so LANCZOS still has detail to work with
+PRESHRINK_SIZE = 320
+
+def load_image(in_image, draft_size=None):
+    """
+    Get an image from a few different sources. JPEG files are decoded at
+    the smallest scale that is still at least draft_size, if given.
+    """
     if type(in_image) == str:
         in_image = Image.open(in_image)
+        if draft_size and in_image.format == 'JPEG':
+            in_image.draft(in_image.mode, draft_size)
     if in_image.mode == 'RGBA':
         return clear_transparent(in_image)
     return in_image
 
 
+def preshrink(image, min_size=PRESHRINK_SIZE):
+    """
+    Cheaply shrink by a whole factor with reduce() while keeping the short
+    side at least min_size, whichever side ends up 160 pixels wide
+    """
+    factor = min(image.size) // min_size
+    if factor >= 2 and image.mode in ('L', 'RGB'):
+        image = image.reduce(factor)
+    return image
+
+
 def clear_transparent(in_image):
     """
     get rid of transparent pixels in image, make then white
@@ -58,7 +93,8 @@ def resize_image_to_160px(image, align='center'):
 
     w,h = image.size
     new_h = int(160 * h / w)
-    image = image.resize((160,new_h),resample=Image.LANCZOS)
+    if w != 160:
+        image = image.resize((160,new_h),resample=Image.LANCZOS)
 
     #pad height to a multiple of 16
     final_h = (new_h-1) // 16 * 16 + 16
@@ -83,24 +119,34 @@ def to_gray(image):
     return image.convert('L')
 
 
+BAYER_4X4 = [[ 0, 8, 2,10],
+             [12, 4,14, 6],
+             [ 3,11, 1, 9],
+             [15, 7,13, 5]]
+
+@lru_cache(maxsize=32)
+def bayer_offsets(shape):
+    """
+    The Bayer matrix tiled over an image shape, as integer offsets. Built
+    once per shape and shared, so it is read only.
+    """
+    h,w = shape
+    num_tiles = tuple([math.ceil(x/4) for x in shape])
+    c = np.tile(BAYER_4X4,num_tiles)[:h,:w]
+    #82*(c/16 - 1/2) in 32nds, 82 being the magic number
+    offsets = (164*c - 1312).astype(np.int32)
+    offsets.flags.writeable = False
+    return offsets
+
 def bayer(image):
     if type(image) == type(Image.new('RGB',(1,1))):
         image = np.array(image)
 
-    coeff = np.array([[ 0, 8, 2,10],
-                      [12, 4,14, 6],
-                      [ 3,11, 1, 9],
-                      [15, 7,13, 5]])
-
-    h,w = image.shape
-    num_tiles = tuple([math.ceil(x/4) for x in image.shape])
-    c = np.tile(coeff,num_tiles)[:h,:w]
-    r = 82 #magic number
-
-    image = image + r*(c/16 - 1/2)
-    image = 85 * np.round(image/85).astype(np.uint8)
-
-    return image
+    #round((image + 82*(c/16 - 1/2)) / 85) in integers, ties to even like np.round
+    n = 32*image.astype(np.int32) + bayer_offsets(image.shape)
+    q, rem = np.divmod(n, 32*85)
+    q += (rem > 16*85) | ((rem == 16*85) & (q & 1 == 1))
+    return (85 * q).astype(np.uint8)
 
 def equal_bins(image):
     if type(image) == type(Image.new('RGB',(1,1))):
@@ -110,7 +156,112 @@ def equal_bins(image):
 def nearest_color(image):
     if type(image) == type(Image.new('RGB',(1,1))):
         image = np.array(image)
-    return 85 * np.round(image/85).astype(np.uint8)
+    return (85 * ((image.astype(np.int32) + 42) // 85)).astype(np.uint8)
+
+#error that wanders past the 0-255 range still lands in this table
+_QUANTIZE_OFFSET = 1024
+
+@lru_cache(maxsize=None)
+def quantize_table():
+    return (85 * np.clip((np.arange(-_QUANTIZE_OFFSET, _QUANTIZE_OFFSET) + 42) // 85,
+                         0, 3)).astype(np.int32)
+
+class ErrorDiffusion:
+    """
+    Error diffusion dither in integers, spreading each pixel's error to its
+    neighbours by (dy, dx, weight) with the sum scaled down by 2**shift.
+
+    Every pixel on the line 2*y + x = t only gets error from pixels with a
+    smaller t, for both Floyd-Steinberg and Atkinson, so each of those
+    anti-diagonal wavefronts is quantized in one vectorized step instead of
+    one pixel at a time.
+    """
+    def __init__(self, kernel, shift, cache_bytes=32*2**20):
+        self.kernel = kernel
+        self.shift = shift
+        #added before shifting, so the error is rounded to nearest instead of
+        #always down, which would darken the whole image a little
+        self.half = 1 << (shift - 1)
+        self.cache_bytes = cache_bytes
+        self._cache = OrderedDict()
+        self._cache_size = 0
+        self._lock = threading.Lock()
+
+    def _wavefronts(self, h, w):
+        """
+        Flat indices into the padded buffer ordered by wavefront, the indices
+        each one's steps are added to, and the bounds of each wavefront in them
+        """
+        y, x = np.mgrid[0:h, 0:w]
+        t = (2*y + x).ravel()
+        flat = (y*(w+4) + x + 2).ravel()
+        order = np.argsort(t, kind='stable')
+        bounds = np.searchsorted(t[order], np.arange(t.max() + 2))
+        indices = flat[order]
+        offsets = np.array([0] + [dy*(w+4) + dx for dy, dx, _ in self.kernel])
+        return indices, indices[:, None] + offsets, bounds
+
+    def wavefronts(self, h, w):
+        """
+        _wavefronts for the image sizes seen lately, least recently used
+        dropped first once they add up to more than cache_bytes
+        """
+        key = h, w
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+                return cached
+        cached = self._wavefronts(h, w)
+        size = sum(a.nbytes for a in cached)
+        if size > self.cache_bytes:
+            return cached
+        with self._lock:
+            old = self._cache.pop(key, None)
+            if old is not None:
+                self._cache_size -= sum(a.nbytes for a in old)
+            self._cache[key] = cached
+            self._cache_size += size
+            while self._cache_size > self.cache_bytes:
+                _, old = self._cache.popitem(last=False)
+                self._cache_size -= sum(a.nbytes for a in old)
+        return cached
+
+    @cached_property
+    def steps(self):
+        """
+        For every value a pixel can reach, plus _QUANTIZE_OFFSET, what gets
+        added to the pixel to quantize it and then to each neighbour in turn
+        """
+        value = np.arange(-_QUANTIZE_OFFSET, _QUANTIZE_OFFSET)
+        error = value - quantize_table()
+        weights = np.array([weight for _, _, weight in self.kernel])
+        spread = (np.multiply.outer(error, weights) + self.half) >> self.shift
+        return np.column_stack([-error, spread]).astype(np.int32)
+
+    def __call__(self, image):
+        if type(image) == type(Image.new('RGB',(1,1))):
+            image = np.array(image)
+        h, w = image.shape
+        #two columns of padding each side and two rows below catch the error
+        #that falls off the edges. Values are stored plus _QUANTIZE_OFFSET so
+        #they index the steps directly.
+        buf = np.zeros((h+2, w+4), dtype=np.int32)
+        buf[:h, 2:w+2] = image
+        buf += _QUANTIZE_OFFSET
+        flat = buf.ravel()
+        steps = self.steps
+        indices, targets, bounds = self.wavefronts(h, w)
+        #the time goes on numpy calls rather than pixels, so each wavefront is
+        #quantized and spread with one lookup and one add.at, which also sums
+        #the error two pixels send to the same neighbour
+        for start, end in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+            np.add.at(flat, targets[start:end], steps[flat[indices[start:end]]])
+        return (buf[:h, 2:w+2] - _QUANTIZE_OFFSET).astype(np.uint8)
+
+floyd_steinberg = ErrorDiffusion([(0, 1, 7), (1, -1, 3), (1, 0, 5), (1, 1, 1)], 4)
+atkinson = ErrorDiffusion([(0, 1, 1), (0, 2, 1), (1, -1, 1), (1, 0, 1), (1, 1, 1),
+                           (2, 0, 1)], 3)
 
 class DitherFactory:
     def __init__(self):
@@ -133,6 +284,8 @@ dither_factory = DitherFactory()
 dither_factory.register('bayer',bayer)
 dither_factory.register('equalbins',equal_bins)
 dither_factory.register('nearest',nearest_color)
+dither_factory.register('floydsteinberg',floyd_steinberg)
+dither_factory.register('atkinson',atkinson)
 
 def dither(image,mode='bayer'):
     """
@@ -160,18 +313,16 @@ def twobit_to_gbtile(arr):
     Converts a twobit array to the gb tile format almost ready to send to the
     GB Printer, you'll have to chop it into 640-byte sections on your own.
     """
-    gbtile = b''
-    rows = arr.shape[0]
-    for strip in np.vsplit(arr,rows//8):
-        for tile in np.hsplit(strip,20):
-            tile_hex = b''
-            for row in tile:
-                low = bytes([sum([(x%2)*(2**(7-i)) for i,x in enumerate(row)])])
-                high = bytes([sum([(x//2)*(2**(7-i)) for i,x in enumerate(row)])])
-                tile_hex = tile_hex + low + high
-            gbtile = gbtile + tile_hex
+    arr = np.asarray(arr, dtype=np.uint8)
+    num_strips = arr.shape[0]//8
+
+    #(strip, row, tile, col) -> (strip, tile, row, col)
+    tiles = arr.reshape(num_strips, 8, 20, 8).transpose(0, 2, 1, 3)
+    #each row becomes a low byte followed by a high byte
+    planes = np.stack([tiles & 1, tiles >> 1], axis=3)
+    gbtile = np.packbits(planes, axis=4)
 
-    return gbtile
+    return gbtile.tobytes()
 
 #black, darkgray, lightgray, white
 PALETTES = {
@@ -202,6 +353,124 @@ def palette_convert(palette_tuple):
     palette_list = [int(color,16) for color in palette_pairs]
     return palette_list
 
+def palette_hex(palette_list):
+    """
+    Inverse of palette_convert, a flat RGB list back to a tuple of hex strings
+    """
+    return tuple(''.join(f'{c:02X}' for c in palette_list[3*i:3*i+3]) for i in range(4))
+
+def palette_list(palette):
+    """
+    Flat RGB list for a palette given either by name or as a tuple of hex strings
+    """
+    if type(palette) == tuple:
+        return palette_convert(palette)
+    return palette_convert(PALETTES[palette])
+
+def palette_lut(palette):
+    """
+    4x3 lookup table of RGB values for a palette given as a flat RGB list,
+    by name or as a tuple of hex strings
+    """
+    if not isinstance(palette, list):
+        palette = palette_list(palette)
+    return np.array(palette[:12], dtype=np.uint8).reshape(4, 3)
+
+def indices_to_rgb(indices, palette, scale=1):
+    """
+    RGB bytes for an array of palette indices, with every pixel blown up to
+    a scale x scale block
+    """
+    h, w = indices.shape
+    #one lookup per source pixel gives its whole row of scale pixels, then
+    #each row is repeated scale times as it is copied out
+    lut = np.tile(palette_lut(palette), (1, scale))
+    rows = lut.take(indices, axis=0)
+    return np.broadcast_to(rows[:, None], (h, scale, w, 3*scale)).tobytes()
+
+def thumbnail_rgb(gbtile, palette, rows=144, shrink=2):
+    """
+    RGB bytes, width and height of a thumbnail of the top rows of a print,
+    shrunk by taking every shrink-th pixel. Only the pages that show up in
+    it are decoded.
+    """
+    pages = -(-rows // 16)
+    twobit = gbtile_to_twobit(gbtile[:pages*640])
+    if len(twobit) == 0:
+        #a print without a whole page in it, a blank strip of paper stands in
+        twobit = np.zeros((16, 160), dtype=np.uint8)
+    indices = (3 - twobit[:rows])[::shrink, ::shrink]
+    h, w = indices.shape
+    return indices_to_rgb(indices, palette), w, h
+
+def open_unique(directory, stamp, ext='.png'):
+    """
+    Create a new file named after stamp, adding _1, _2, ... if that name is
+    already taken, so nothing ever gets overwritten
+    """
+    for n in itertools.count():
+        name = f'{stamp}{ext}' if n == 0 else f'{stamp}_{n}{ext}'
+        try:
+            return open(os.path.join(directory, name), 'xb')
+        except FileExistsError:
+            pass
+
+
+def write_png(image, directory, stamp):
+    with open_unique(directory, stamp) as f:
+        image.save(f, 'PNG')
+        return f.name
+
+
+class SaveQueue:
+    """
+    Encodes and writes PNGs on a small worker pool, so the printer and GUI
+    threads never wait on the disk. The name is stamped with the time the
+    image was handed over, not the time it was written.
+    """
+    def __init__(self, workers=2):
+        self._pool = ThreadPoolExecutor(max_workers=workers,
+                                        thread_name_prefix='save_image')
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def submit(self, image, directory='gbp_out'):
+        """
+        Queue a PIL image to be saved, returns a future for the path. Don't
+        change the image afterwards, hand over a copy if you need to.
+        """
+        stamp = time.strftime('gbp_%Y%m%d_%H%M%S')
+        future = self._pool.submit(write_png, image, directory, stamp)
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        with self._lock:
+            self._pending.discard(future)
+        if future.exception():
+            log.error(f'Could not save image: {future.exception()!r}')
+
+    def flush(self, timeout=None):
+        """Wait for every image queued so far to be written"""
+        with self._lock:
+            pending = list(self._pending)
+        wait(pending, timeout)
+
+    def shutdown(self):
+        self._pool.shutdown(wait=True)
+
+save_queue = SaveQueue()
+atexit.register(save_queue.flush)
+
+def save_image(image, directory='gbp_out'):
+    """
+    Save a PIL image to the output folder with a timestamped name, in the
+    background. Returns a future for the path.
+    """
+    return save_queue.submit(image, directory)
+
 def twobit_to_image(arr, palette='gray', save=False):
     """
     Convert an image matrix back into a PIL image object
@@ -210,13 +479,10 @@ def twobit_to_image(arr, palette='gray', save=False):
     arr_flip = 3 - arr
 
     image = Image.fromarray(arr_flip,'P')
-    if type(palette) == tuple:
-        image.putpalette(palette_convert(palette))
-    else:
-        image.putpalette(palette_convert(PALETTES[palette]))
+    image.putpalette(palette_list(palette))
         
     if save:
-        image.save(time.strftime('gbp_out/gbp_%Y%m%d_%H%M%S.png'),'PNG')
+        save_image(image)
     return image
 
 def gbtile_to_twobit(gbtile_bytes):
@@ -224,26 +490,74 @@ def gbtile_to_twobit(gbtile_bytes):
     converts bytes in GB tile format to 2-bit matrix
     """
 
-    #only needed for dealing with compressed data that's not uncompressed
-    #testing only, probably no longer needed
-    #padding = bytes(640-(len(gbtile_bytes)%640))
-    #gbtile_bytes = gbtile_bytes + bytes(padding)
-
+    #every 640 bytes is a page of two strips, each strip is 20 tiles of 8
+    #rows, each row is a low byte followed by a high byte
     num_pages = len(gbtile_bytes)//640
-    twobit = np.empty((16*num_pages,160))
+    num_strips = num_pages*2
+    raw = np.frombuffer(gbtile_bytes, dtype=np.uint8, count=num_pages*640)
+    planes = np.unpackbits(raw.reshape(num_strips, 20, 8, 2), axis=3)
+    #planes is now (strip, tile, row, low/high bits), MSB first
+    twobit = planes[..., 0:8] + 2*planes[..., 8:16]
+    twobit = twobit.transpose(0, 2, 1, 3).reshape(num_strips*8, 160)
+
+    return twobit
 
-    for s in range(num_pages*2):
-        strip_bytes = gbtile_bytes[320*s:320*(s+1)]
-        for t in range(20):
-            tile_bytes = strip_bytes[16*t:16*(t+1)]
-            for r in range(8):
-                row_bytes = tile_bytes[2*r:2*(r+1)]
-                low, high = row_bytes
-                mat_row = [(low>>i & 1) + 2*(high>>i & 1) for i in reversed(range(8))]
-                twobit[s*8+r,t*8:(t+1)*8] = mat_row
 
-    return twobit.astype(np.uint8)
 
+class TwobitCanvas:
+    """
+    A 2-bit image that grows one band of gbtile data at a time, so a print
+    received line by line only ever decodes each band once.
+
+    Pixels are stored as palette indices (3 - twobit), the same layout
+    twobit_to_image hands to PIL, which lets image() wrap the canvas without
+    copying it.
+    """
+    def __init__(self, capacity=288, spill_size=16*2**20):
+        #grows capacity rows at a time, in a temporary file past spill_size
+        self._store = buffers.SpillBuffer(160*capacity, spill_size)
+        self.rows = 0
+        #bytes past the last whole page, decoded once the rest of it arrives
+        self._leftover = b''
+
+    def clear(self):
+        #start a fresh buffer so images handed out earlier are never overwritten
+        self._store.clear()
+        self.rows = 0
+        self._leftover = b''
+
+    def append(self, gbtile_bytes):
+        """
+        Decode new gbtile bytes onto the bottom of the canvas and return the
+        (start, end) range of rows that changed. Only whole pages are decoded,
+        the rest is kept and decoded along with the next bytes.
+        """
+        with metrics.convert_seconds.time('canvas_append'):
+            if self._leftover:
+                gbtile_bytes = self._leftover + bytes(gbtile_bytes)
+            whole = len(gbtile_bytes) // 640 * 640
+            self._leftover = bytes(gbtile_bytes[whole:])
+            band = gbtile_to_twobit(gbtile_bytes)
+            start = self.rows
+            self._store.append(3 - band)
+        self.rows = start + band.shape[0]
+        return start, self.rows
+
+    @property
+    def view(self):
+        """Palette indices of every row received so far"""
+        return np.frombuffer(self._store.view, dtype=np.uint8).reshape(self.rows, 160)
+
+    def image(self, palette='gray', save=False):
+        """
+        PIL image backed by the canvas memory, no pixel data is copied
+        """
+        image = Image.frombuffer('P', (160, self.rows), self.view,
+                                 'raw', 'P', 0, 1)
+        image.putpalette(palette_list(palette))
+        if save:
+            save_image(image)
+        return image
 
 
 def image_to_gbtile(image,dither_mode='bayer',rotate='auto',align='center'):
@@ -262,6 +576,7 @@ def gbtile_to_image(gbtile,palette='gray',save=False):
     """
     Full conversion from gbtile to an image object. Optionally aves it
     """
-    image_mat = gbtile_to_twobit(gbtile)
-    image_obj = twobit_to_image(image_mat, palette, save)
+    with metrics.convert_seconds.time('gbtile_to_image'):
+        image_mat = gbtile_to_twobit(gbtile)
+        image_obj = twobit_to_image(image_mat, palette, save)
     return image_obj
\ No newline at end of file
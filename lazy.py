@@ -0,0 +1,27 @@
+import importlib.util
+import sys
+
+
+def lazy_import(name):
+    """
+    The module called name, only actually loaded the first time one of its
+    attributes is used, so heavy dependencies cost nothing at startup for
+    code paths that never touch them. Modules already imported are returned
+    as they are.
+    """
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f'No module named {name!r}', name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    parent, _, child = name.rpartition('.')
+    if parent:
+        #what a normal import does, so "import PIL.Image" finds it too
+        setattr(sys.modules[parent], child, module)
+    return module
@@ -1,9 +1,19 @@
 import wx
 import window
+import profiling
+import argparse
 import logging
 
 logging.basicConfig(level=logging.INFO)
 
+parser = argparse.ArgumentParser(description='Game Boy Printer emulator GUI')
+parser.add_argument('--archive', help='print archive to keep the history in, '
+                    'otherwise it only lasts the session')
+profiling.add_arguments(parser)
+args = parser.parse_args()
+profiling.start_from_env(profiling.GUI_HOT_PATH, args.profile, args.profile_packets)
+
 app = wx.App(False)
-frame = window.MainWindow()
-app.MainLoop()
\ No newline at end of file
+frame = window.MainWindow(archive_path=args.archive)
+app.MainLoop()
+profiling.stop()
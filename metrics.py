@@ -0,0 +1,204 @@
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+REGISTRY = []
+
+
+class Counter:
+    """A total that only goes up, optionally split by one label"""
+    kind = 'counter'
+
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, amount=1, label_value=''):
+        with self._lock:
+            self._values[label_value] = self._values.get(label_value, 0) + amount
+
+    def value(self, label_value=None):
+        """The total for one label value, or across all of them"""
+        with self._lock:
+            if label_value is None:
+                return sum(self._values.values())
+            return self._values.get(label_value, 0)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+    def samples(self):
+        for label_value, value in sorted(self.snapshot().items()):
+            yield self.name, self._labels(label_value), value
+
+    def _labels(self, label_value, **extra):
+        labels = dict(extra)
+        if self.label:
+            labels = {self.label: label_value, **labels}
+        return labels
+
+
+class Histogram(Counter):
+    """Counts observations into cumulative buckets, plus their sum"""
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets, label=None):
+        self.buckets = sorted(buckets)
+        super().__init__(name, help, label)
+
+    def observe(self, value, label_value=''):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(label_value)
+            if counts is None:
+                counts = self._values[label_value] = [0]*(len(self.buckets)+1) + [0.0]
+            counts[i] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, label_value=''):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, label_value)
+
+    def value(self, label_value=None):
+        """Number of observations for one label value, or across all of them"""
+        with self._lock:
+            values = self._values.values() if label_value is None \
+                else [self._values.get(label_value, [0])]
+            return sum(sum(counts[:-1]) for counts in values if len(counts) > 1)
+
+    def snapshot(self):
+        with self._lock:
+            values = {k: list(v) for k, v in self._values.items()}
+        return {label_value: {'count': sum(counts[:-1]), 'sum': counts[-1],
+                              'buckets': dict(zip(self.buckets, counts))}
+                for label_value, counts in values.items()}
+
+    def samples(self):
+        for label_value, stats in sorted(self.snapshot().items()):
+            total = 0
+            for bound, count in stats['buckets'].items():
+                total += count
+                yield f'{self.name}_bucket', self._labels(label_value, le=f'{bound:g}'), total
+            yield f'{self.name}_bucket', self._labels(label_value, le='+Inf'), stats['count']
+            yield f'{self.name}_sum', self._labels(label_value), stats['sum']
+            yield f'{self.name}_count', self._labels(label_value), stats['count']
+
+
+LATENCY_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1]
+
+serial_bytes = Counter('gbp_serial_bytes_total', 'Bytes read from the dongle')
+serial_lines = Counter('gbp_serial_lines_total', 'Lines read from the dongle')
+serial_timeouts = Counter('gbp_serial_timeouts_total', 'Reads that timed out without a line')
+parse_failures = Counter('gbp_parse_failures_total', 'Lines that were not a packet',
+                         label='reason')
+packets = Counter('gbp_packets_total', 'Packets handled', label='command')
+packet_errors = Counter('gbp_packet_errors_total', 'Packets that failed validation',
+                        label='reason')
+handle_seconds = Histogram('gbp_handle_packet_seconds', 'Time spent handling a packet',
+                           LATENCY_BUCKETS, label='command')
+convert_seconds = Histogram('gbp_convert_seconds', 'Time spent converting image data',
+                            LATENCY_BUCKETS, label='step')
+read_to_image_seconds = Histogram('gbp_read_to_image_seconds',
+                                  'From a line being parsed to its image being ready',
+                                  LATENCY_BUCKETS)
+
+
+def snapshot():
+    """Every metric's current value, keyed by name and then label value"""
+    return {metric.name: metric.snapshot() for metric in REGISTRY}
+
+
+_last_stats = {'time': time.monotonic(), 'bytes': 0, 'packets': 0}
+_stats_lock = threading.Lock()
+
+def stats():
+    """
+    A summary of the metrics, with bytes/sec and packets/sec averaged since
+    the previous call
+    """
+    now = time.monotonic()
+    total_bytes = serial_bytes.value()
+    total_packets = packets.value()
+    with _stats_lock:
+        elapsed = max(now - _last_stats['time'], 1e-9)
+        bytes_per_sec = (total_bytes - _last_stats['bytes']) / elapsed
+        packets_per_sec = (total_packets - _last_stats['packets']) / elapsed
+        _last_stats.update(time=now, bytes=total_bytes, packets=total_packets)
+    return {
+        'bytes_per_sec': bytes_per_sec,
+        'packets_per_sec': packets_per_sec,
+        'packets': packets.snapshot(),
+        'checksum_errors': packet_errors.value('BAD_CHECKSUM'),
+        'magic_errors': packet_errors.value('BAD_MAGIC_BYTES'),
+        'packet_errors': packet_errors.snapshot(),
+        'parse_failures': parse_failures.snapshot(),
+        'read_to_image': read_to_image_seconds.snapshot().get(''),
+        'convert': convert_seconds.snapshot(),
+    }
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels.items()) + '}'
+
+def _format_value(value):
+    #:g would round a counter past a million to 6 digits, repr keeps them all
+    if isinstance(value, int):
+        return str(value)
+    if value != value:
+        return 'NaN'
+    if value in (float('inf'), float('-inf')):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(value)
+
+def prometheus_text():
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        for name, labels, value in metric.samples():
+            lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+    return '\n'.join(lines) + '\n'
+
+def write_prometheus(path):
+    """Write the metrics file in one go, so a scraper never sees half of it"""
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as f:
+        f.write(prometheus_text())
+    os.replace(tmp, path)
+
+
+class PrometheusFileWriter(threading.Thread):
+    """Rewrites a Prometheus text file every interval seconds until stopped"""
+    def __init__(self, path, interval=15):
+        threading.Thread.__init__(self, daemon=True, name='metrics')
+        self.path = path
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                write_prometheus(self.path)
+            except OSError as e:
+                log.warning(f'Could not write metrics to {self.path}: {e}')
+
+    def stop(self):
+        self._stop_event.set()
+        write_prometheus(self.path)
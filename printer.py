@@ -0,0 +1,180 @@
+import emulator
+import rle
+from emulator import INIT, PRINT, DATA, STATUS, PRINTING, CHECKSUM_ERROR, \
+    PACKET_ERROR, PAPER_JAM, OTHER_ERROR, LOW_BATTERY, MAX_PAGES
+
+import argparse
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+log = logging.getLogger(__name__)
+
+PAGE_SIZE = 640
+ERROR_BITS = [CHECKSUM_ERROR, PACKET_ERROR, PAPER_JAM, OTHER_ERROR, LOW_BATTERY]
+
+
+class PrinterError(IOError):
+    pass
+
+
+def make_packet(command, payload=b'', compressed=False):
+    """
+    Frames a packet: magic bytes, header, payload, checksum and the two
+    bytes the printer answers during
+    """
+    header = bytes([command, int(compressed), len(payload) % 256, len(payload) // 256])
+    checksum = (sum(header) + sum(payload)) % (256**2)
+    return b'\x88\x33' + header + bytes(payload) + \
+        bytes([checksum % 256, checksum // 256, 0x00, 0x00])
+
+
+def make_data_packet(page, compress=False):
+    """DATA packet for one page, compressed only if that makes it smaller"""
+    if compress:
+        comp = rle.compress(page)
+        if len(comp) < len(page):
+            return make_packet(DATA, comp, compressed=True)
+    return make_packet(DATA, page)
+
+
+def make_print_packet(top_margin=0, bottom_margin=3, sheets=1,
+                      palette=0xE4, exposure=0x40):
+    margins = (top_margin << 4) | bottom_margin
+    return make_packet(PRINT, bytes([sheets, margins, palette, exposure]))
+
+
+class Link:
+    """
+    Whatever carries packets to a printer. send delivers one packet and
+    returns the status byte the printer answered with.
+    """
+    def send(self, packet):
+        raise NotImplementedError
+
+
+class LoopbackLink(Link):
+    """
+    Delivers packets straight to one of our own Emulators, standing in for
+    a real printer. Images the emulator hands back are kept in images.
+    """
+    def __init__(self, emu=None, **kwargs):
+        self.emulator = emu if emu else emulator.Emulator(**kwargs)
+        self.images = []
+
+    def send(self, packet):
+        ret = self.emulator.handle_packet(emulator.GBPacket(packet))
+        if ret and ret[0] is not None and ret[1] == 'complete':
+            self.images.append(ret[0])
+        return self.emulator.status_byte
+
+
+class PrinterDriver:
+    """
+    Sends gbtile data to a printer over a link. The next packet is framed
+    (and compressed) on a helper thread while the current one is in flight,
+    so the link never waits on packet preparation.
+    """
+    def __init__(self, link, compress=True, poll_interval=0.1, poll_timeout=30):
+        self.log = logging.getLogger('printer')
+        self.link = link
+        self.compress = compress
+        self.poll_interval = poll_interval
+        self.poll_timeout = poll_timeout
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='packets')
+
+    def packets(self, gbtile, top_margin=0, bottom_margin=3):
+        """
+        Yields callables that build each packet of the job, in order, and
+        None where the printer has to finish before going on. The printer
+        only holds 9 pages, so longer data is split into batches, each ending
+        with PRINT. Only the last batch gets a bottom margin.
+        """
+        pages = [gbtile[i:i+PAGE_SIZE] for i in range(0, len(gbtile), PAGE_SIZE)]
+        yield partial(make_packet, INIT)
+        for first in range(0, len(pages), MAX_PAGES):
+            for page in pages[first:first+MAX_PAGES]:
+                yield partial(make_data_packet, page, self.compress)
+            top = top_margin if first == 0 else 0
+            bottom = bottom_margin if first + MAX_PAGES >= len(pages) else 0
+            yield partial(make_packet, DATA)
+            yield partial(make_print_packet, top, bottom)
+            yield None #wait for the printer before the next batch
+
+    def send(self, packet):
+        status = self.link.send(packet)
+        errors = [emulator.status_text[bit] for bit in ERROR_BITS if status >> bit & 1]
+        if errors:
+            raise PrinterError(f'Printer reported {", ".join(errors)}')
+        return status
+
+    def wait_until_done(self):
+        """Polls STATUS until the printer is no longer printing"""
+        deadline = time.monotonic() + self.poll_timeout
+        status_packet = make_packet(STATUS)
+        while self.send(status_packet) >> PRINTING & 1:
+            if time.monotonic() > deadline:
+                raise PrinterError(f'Printer still busy after {self.poll_timeout} s')
+            if self.poll_interval:
+                time.sleep(self.poll_interval)
+
+    def print_gbtile(self, gbtile, top_margin=0, bottom_margin=3):
+        """Prints gbtile data, returns the number of pages sent"""
+        steps = list(self.packets(gbtile, top_margin, bottom_margin))
+        pending = None
+        for i, step in enumerate(steps):
+            if step is None:
+                self.wait_until_done()
+                continue
+            if pending and pending[0] == i:
+                packet = pending[1].result()
+            else:
+                packet = step()
+            #frame the next packet while this one is being sent
+            following = next((j for j in range(i+1, len(steps)) if steps[j]), None)
+            pending = (following, self._pool.submit(steps[following])) \
+                if following is not None else None
+            self.send(packet)
+        return len(gbtile) // PAGE_SIZE
+
+    def shutdown(self):
+        self._pool.shutdown(wait=True)
+
+
+def loopback_print(gbtile, compress=True, **emulator_kwargs):
+    """
+    Print gbtile data to an Emulator through the driver. Returns the images
+    that came out and the seconds it took.
+    """
+    link = LoopbackLink(**emulator_kwargs)
+    driver = PrinterDriver(link, compress=compress, poll_interval=0)
+    start = time.perf_counter()
+    driver.print_gbtile(gbtile)
+    elapsed = time.perf_counter() - start
+    driver.shutdown()
+    return link.images, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Print gbtile data through the '
+                                     'driver to an emulated printer')
+    parser.add_argument('path', help='.gbtile file, e.g. from batch.py')
+    parser.add_argument('--no-compress', action='store_true',
+                        help='send every DATA packet uncompressed')
+    parser.add_argument('--save', action='store_true', help='save what comes out')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger('emulator').setLevel(logging.WARNING)
+    with open(args.path, 'rb') as f:
+        gbtile = f.read()
+    images, elapsed = loopback_print(gbtile, compress=not args.no_compress,
+                                     auto_save=args.save)
+    pages = len(gbtile) // PAGE_SIZE
+    print(f'{pages} pages in {elapsed:.3f} s, {pages/max(elapsed, 1e-9):.0f} pages/sec, '
+          f'{len(images)} image(s) printed')
+
+
+if __name__ == '__main__':
+    main()
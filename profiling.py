@@ -0,0 +1,192 @@
+import atexit
+import collections
+import functools
+import importlib
+import io
+import json
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+#what gets wrapped in timing spans, as (module, attribute path)
+HOT_PATH = [
+    ('emulator', 'Emulator.handle_packet'),
+    ('image', 'gbtile_to_image'),
+]
+GUI_HOT_PATH = HOT_PATH + [
+    ('window', 'PrinterThread.run'),
+    ('window', 'MainWindow.update_image'),
+]
+PROFILED = ('emulator', 'Emulator.handle_packet')
+
+ENV_DIR = 'GBP_PROFILE'
+ENV_PACKETS = 'GBP_PROFILE_PACKETS'
+
+_profiler = None
+
+
+class Profiler:
+    """
+    Wraps the targets in timing spans and, for the first profile_packets
+    calls of the PROFILED function, runs cProfile as well. Nothing is wrapped
+    until start(), and stop() puts the original functions back, so code runs
+    exactly as before while profiling is off.
+    """
+    def __init__(self, out_dir='gbp_profile', profile_packets=0,
+                 targets=HOT_PATH, max_spans=200000):
+        self.out_dir = out_dir
+        self.profile_packets = profile_packets
+        self.targets = targets
+        self.spans = collections.deque(maxlen=max_spans)
+        self.profile = None
+        if profile_packets:
+            #only loaded when asked for, every entry point imports this module
+            import cProfile
+            self.profile = cProfile.Profile()
+        self.profiled = 0
+        self._profile_lock = threading.Lock()
+        self._originals = []
+        self._origin = time.perf_counter_ns()
+
+    def start(self):
+        for module_name, path in self.targets:
+            owner = importlib.import_module(module_name)
+            *parents, attr = path.split('.')
+            for parent in parents:
+                owner = getattr(owner, parent)
+            func = owner.__dict__[attr]
+            profiled = (module_name, path) == PROFILED and self.profile is not None
+            setattr(owner, attr, self.wrap(func, path, profiled))
+            self._originals.append((owner, attr, func))
+        log.info(f'Profiling {", ".join(path for _, path in self.targets)} '
+                 f'into {self.out_dir}')
+
+    def stop(self):
+        for owner, attr, func in reversed(self._originals):
+            setattr(owner, attr, func)
+        self._originals.clear()
+
+    def wrap(self, func, name, profiled=False):
+        spans = self.spans
+        perf_counter_ns = time.perf_counter_ns
+        get_ident = threading.get_ident
+
+        @functools.wraps(func)
+        def span(*args, **kwargs):
+            start = perf_counter_ns()
+            try:
+                if profiled and self.profiled < self.profile_packets:
+                    return self.run_profiled(func, *args, **kwargs)
+                return func(*args, **kwargs)
+            finally:
+                spans.append((name, get_ident(), start, perf_counter_ns() - start))
+        return span
+
+    def run_profiled(self, func, *args, **kwargs):
+        #cProfile can only be enabled once at a time
+        if not self._profile_lock.acquire(blocking=False):
+            return func(*args, **kwargs)
+        try:
+            self.profile.enable()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.profile.disable()
+                self.profiled += 1
+                if self.profiled == self.profile_packets:
+                    self.dump_profile()
+        finally:
+            self._profile_lock.release()
+
+    def dump_profile(self):
+        """Write cProfile stats, raw and as a text table sorted by cumulative time"""
+        if not self.profiled:
+            return
+        import pstats
+        os.makedirs(self.out_dir, exist_ok=True)
+        path = os.path.join(self.out_dir, 'profile.pstats')
+        self.profile.dump_stats(path)
+        text = io.StringIO()
+        stats = pstats.Stats(self.profile, stream=text)
+        stats.sort_stats('cumulative').print_stats(50)
+        with open(os.path.join(self.out_dir, 'profile.txt'), 'w') as f:
+            f.write(f'First {self.profiled} packets\n')
+            f.write(text.getvalue())
+        log.info(f'Profile of {self.profiled} packets written to {path}')
+
+    def dump_spans(self):
+        """
+        Write the spans as a Chrome trace, which chrome://tracing and Perfetto
+        show as a timeline, plus per span totals
+        """
+        spans = list(self.spans)
+        os.makedirs(self.out_dir, exist_ok=True)
+        pid = os.getpid()
+        events = [{'name': name, 'ph': 'X', 'pid': pid, 'tid': tid,
+                   'ts': (start - self._origin) / 1000, 'dur': duration / 1000}
+                  for name, tid, start, duration in spans]
+        with open(os.path.join(self.out_dir, 'spans.json'), 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        totals = collections.defaultdict(list)
+        for name, _, _, duration in spans:
+            totals[name].append(duration)
+        with open(os.path.join(self.out_dir, 'spans.txt'), 'w') as f:
+            f.write(f'{"span":<28} {"calls":>8} {"total ms":>10} {"mean ms":>9} {"max ms":>9}\n')
+            for name, durations in sorted(totals.items()):
+                f.write(f'{name:<28} {len(durations):8d} {sum(durations)/1e6:10.2f} '
+                        f'{sum(durations)/len(durations)/1e6:9.3f} {max(durations)/1e6:9.3f}\n')
+        return len(events)
+
+    def dump(self):
+        if self.profiled < self.profile_packets: #otherwise already written
+            self.dump_profile()
+        count = self.dump_spans()
+        log.info(f'{count} spans written to {self.out_dir}')
+
+
+def start(out_dir='gbp_profile', profile_packets=0, targets=HOT_PATH):
+    """Start profiling, results are written when the process exits"""
+    global _profiler
+    if _profiler is not None:
+        return _profiler
+    _profiler = Profiler(out_dir, profile_packets, targets)
+    _profiler.start()
+    atexit.register(stop)
+    return _profiler
+
+def stop():
+    """Unwrap everything and write the results"""
+    global _profiler
+    if _profiler is None:
+        return
+    profiler, _profiler = _profiler, None
+    atexit.unregister(stop)
+    profiler.stop()
+    profiler.dump()
+
+def start_from_env(targets=HOT_PATH, out_dir=None, profile_packets=None):
+    """
+    Start profiling if asked to on the command line (out_dir) or through the
+    GBP_PROFILE environment variable, a directory or 1 for gbp_profile.
+    GBP_PROFILE_PACKETS sets how many packets get cProfiled.
+    """
+    if out_dir is None:
+        out_dir = os.environ.get(ENV_DIR)
+        if out_dir in (None, '', '0'):
+            return None
+        if out_dir == '1':
+            out_dir = 'gbp_profile'
+    if profile_packets is None:
+        profile_packets = int(os.environ.get(ENV_PACKETS, 0))
+    return start(out_dir, profile_packets, targets)
+
+def add_arguments(parser):
+    """The --profile options, for scripts with an argparse parser"""
+    parser.add_argument('--profile', metavar='DIR', nargs='?', const='gbp_profile',
+                        help=f'time the hot path and write results to DIR, '
+                             f'also switched on by {ENV_DIR}')
+    parser.add_argument('--profile-packets', type=int, metavar='N',
+                        help=f'cProfile the first N packets, also {ENV_PACKETS}')
@@ -0,0 +1,83 @@
+import re
+
+PAGE_SIZE = 640
+MAX_LITERAL = 128
+MAX_RUN = 129
+
+#three or more of the same byte, shorter repeats are cheaper as literals
+_RUN = re.compile(rb'(.)\1{2,}', re.DOTALL)
+
+
+def decompress(comp_data, out=None):
+    """
+    Expands the printer's run-length encoding into out, a fresh 640-byte
+    buffer if none is given, and returns a memoryview of all of out. Data
+    that expands to less than that is padded with zeros, like a short page
+    always was, so a reused buffer never shows the previous page.
+
+    A command byte with the high bit set is a run: the next byte repeated
+    (command - 0x80 + 2) times. Otherwise it is followed by (command + 1)
+    literal bytes. Raises ValueError if the data is cut short or would
+    write past the end of out.
+    """
+    if out is None:
+        out = bytearray(PAGE_SIZE)
+    comp = bytes(comp_data)
+    len_comp = len(comp)
+    len_out = len(out)
+    comp_offset = 0
+    raw_offset = 0
+    while comp_offset < len_comp:
+        command_byte = comp[comp_offset]
+        comp_offset += 1
+        if command_byte & 0x80: #compressed run
+            length = command_byte - 0x80 + 2
+            if comp_offset >= len_comp:
+                raise ValueError('Compressed run is missing its byte')
+            if raw_offset + length > len_out:
+                raise ValueError(f'Compressed data overruns {len_out} bytes')
+            out[raw_offset:raw_offset+length] = comp[comp_offset:comp_offset+1] * length
+            comp_offset += 1
+        else: #uncompressed run
+            length = command_byte + 1
+            if comp_offset + length > len_comp:
+                raise ValueError('Uncompressed run is cut short')
+            if raw_offset + length > len_out:
+                raise ValueError(f'Compressed data overruns {len_out} bytes')
+            out[raw_offset:raw_offset+length] = comp[comp_offset:comp_offset+length]
+            comp_offset += length
+        raw_offset += length
+    out[raw_offset:] = bytes(len_out - raw_offset)
+    return memoryview(out)
+
+
+def _add_literal(comp, raw, start, end):
+    for i in range(start, end, MAX_LITERAL):
+        chunk = raw[i:min(i+MAX_LITERAL, end)]
+        comp.append(len(chunk) - 1)
+        comp += chunk
+
+
+def compress(raw_data):
+    """
+    Run-length encodes bytes the way the printer expects, for example one
+    640-byte page of image_to_gbtile output. decompress undoes it.
+    """
+    raw = bytes(raw_data)
+    comp = bytearray()
+    literal_start = 0
+    for match in _RUN.finditer(raw):
+        start, end = match.span()
+        _add_literal(comp, raw, literal_start, start)
+        duped_byte = raw[start]
+        remaining = end - start
+        while remaining:
+            length = min(remaining, MAX_RUN)
+            if remaining - length == 1: #never leave a run of one behind
+                length -= 1
+            comp.append(0x80 + length - 2)
+            comp.append(duped_byte)
+            remaining -= length
+        literal_start = end
+    _add_literal(comp, raw, literal_start, len(raw))
+    return bytes(comp)
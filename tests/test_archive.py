@@ -0,0 +1,117 @@
+import os
+
+import pytest
+
+import archive
+import benchmark
+import emulator
+import printer
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'prints.gbparc')
+
+
+def fill(path, prints=5, pages=2):
+    gbtiles = [benchmark.make_camera_gbtile(pages, seed=i) for i in range(prints)]
+    with archive.PrintArchive(path) as arc:
+        for i, gbtile in enumerate(gbtiles):
+            assert arc.append(gbtile, palette='gbgreen', port=f'/dev/ttyUSB{i}',
+                              timestamp=1000.0 + i) == i
+    return gbtiles
+
+
+def check(path, gbtiles):
+    with archive.PrintArchive(path) as arc:
+        assert len(arc) == len(gbtiles)
+        for i, (printed, gbtile) in enumerate(zip(arc, gbtiles)):
+            assert printed.number == i
+            assert printed.timestamp == 1000.0 + i
+            assert printed.port == f'/dev/ttyUSB{i}'
+            assert printed.palette == 'gbgreen'
+            assert bytes(printed.gbtile) == gbtile
+        assert bytes(arc[-1].gbtile) == gbtiles[-1]
+
+
+def test_append_and_reopen(path):
+    check(path, fill(path))
+
+
+def test_palette_tuple(path):
+    palette = ('000000', '010203', 'C86432', 'FFFFFF')
+    with archive.PrintArchive(path) as arc:
+        arc.append(bytes(640), palette=palette)
+    with archive.PrintArchive(path) as arc:
+        assert arc[0].palette == palette
+        assert arc[0].pages == 1
+
+
+def test_out_of_range(path):
+    fill(path, prints=2)
+    with archive.PrintArchive(path) as arc:
+        with pytest.raises(IndexError):
+            arc[2]
+        with pytest.raises(IndexError):
+            arc[-3]
+
+
+def test_missing_index_is_rebuilt(path):
+    gbtiles = fill(path)
+    os.remove(path + '.idx')
+    check(path, gbtiles)
+    assert os.path.getsize(path + '.idx') == len(gbtiles)*archive.INDEX.size
+
+
+def test_short_index_is_rebuilt(path):
+    gbtiles = fill(path)
+    with open(path + '.idx', 'r+b') as f:
+        f.truncate(2*archive.INDEX.size + 3)
+    check(path, gbtiles)
+
+
+@pytest.mark.parametrize('cut', [1, archive.RECORD.size, 700])
+def test_half_written_record_is_dropped(path, cut):
+    gbtiles = fill(path)
+    size = os.path.getsize(path)
+    with open(path, 'ab') as f:
+        f.write(archive.RECORD.pack(archive.MARKER, 0, 2, 1280) + b'{}' + bytes(1280))
+    #the index entry is only written once the record is complete
+    with open(path, 'r+b') as f:
+        f.truncate(size + cut)
+    check(path, gbtiles)
+    assert os.path.getsize(path) == size
+
+
+def test_index_past_the_end_is_dropped(path):
+    gbtiles = fill(path)
+    with open(path + '.idx', 'ab') as f:
+        f.write(archive.INDEX.pack(os.path.getsize(path) + 100))
+    check(path, gbtiles)
+
+
+def test_not_an_archive(path):
+    with open(path, 'wb') as f:
+        f.write(b'something else')
+    with pytest.raises(ValueError):
+        archive.PrintArchive(path)
+
+
+def test_prints_survive_appends(path):
+    #a print read earlier keeps its data while the archive is remapped
+    gbtiles = fill(path, prints=1)
+    with archive.PrintArchive(path) as arc:
+        first = arc[0]
+        for i in range(20):
+            arc.append(bytes(640*9))
+            arc[-1]
+        assert bytes(first.gbtile) == gbtiles[0]
+        del first
+
+
+def test_paper_feed_is_not_archived(path):
+    with archive.PrintArchive(path) as arc:
+        emu = emulator.Emulator(archive=arc)
+        for packet in [printer.make_packet(emulator.INIT), printer.make_print_packet()]:
+            emu.handle_packet(emulator.GBPacket(packet))
+        assert len(arc) == 0
@@ -0,0 +1,73 @@
+import asyncio
+import random
+
+import async_emulator
+import benchmark
+import emulator
+import printer
+
+
+def data_lines(pages, seed=0):
+    rng = random.Random(seed)
+    return [benchmark.make_hex_line(printer.make_packet(emulator.DATA, rng.randbytes(640))).strip()
+            for _ in range(pages)]
+
+
+async def collect(emu):
+    return [status async for _, status in emu.images()]
+
+
+def test_memory_source_reads_then_runs_dry():
+    async def run():
+        source = async_emulator.MemorySource([b'a', b'b'])
+        source.close()
+        return [await source.read_line() for _ in range(4)]
+    assert asyncio.run(run()) == [b'a', b'b', None, None]
+
+
+def test_memory_source_times_out():
+    async def run():
+        return await async_emulator.MemorySource().read_line(timeout=0.01)
+    assert asyncio.run(run()) == b''
+
+
+def test_images_from_memory_source():
+    lines = data_lines(3)
+
+    async def run():
+        source = async_emulator.MemorySource(lines)
+        source.close()
+        emu = async_emulator.AsyncEmulator(convert_by_line=True)
+        await emu.init(source)
+        return await collect(emu)
+    assert asyncio.run(run()) == ['partial']*3
+
+
+def test_dongles_share_a_loop():
+    async def run():
+        emus = []
+        for i in range(4):
+            source = async_emulator.MemorySource()
+            emu = async_emulator.AsyncEmulator(convert_by_line=True)
+            await emu.init(source)
+            emus.append((emu, source))
+        tasks = [asyncio.create_task(collect(emu)) for emu, _ in emus]
+        #lines turn up on every source in turn, like several dongles at once
+        for line in data_lines(2):
+            for _, source in emus:
+                source.feed(line)
+                await asyncio.sleep(0)
+        for _, source in emus:
+            source.close()
+        return await asyncio.gather(*tasks)
+    assert asyncio.run(run()) == [['partial']*2]*4
+
+
+def test_junk_lines_are_skipped():
+    async def run():
+        source = async_emulator.MemorySource([b'', b'junk'] + data_lines(1))
+        source.close()
+        emu = async_emulator.AsyncEmulator()
+        await emu.init(source)
+        return [packet.command async for packet in emu.packets()]
+    assert asyncio.run(run()) == [emulator.DATA]
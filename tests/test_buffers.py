@@ -0,0 +1,78 @@
+import numpy as np
+
+import buffers
+import image
+
+
+def test_page_buffer_fills_up():
+    pages = buffers.PageBuffer(2)
+    assert pages.append(b'\x01'*640)
+    assert pages.append(b'\x02'*600)
+    assert not pages.append(b'\x03'*41)
+    assert pages.append(b'\x03'*40)
+    assert len(pages) == pages.capacity == 1280
+    assert bytes(pages.view) == b'\x01'*640 + b'\x02'*600 + b'\x03'*40
+    pages.clear()
+    assert len(pages) == 0 and bytes(pages.view) == b''
+
+
+def test_spill_buffer_grows_in_memory():
+    spill = buffers.SpillBuffer(chunk_size=100, spill_size=1000)
+    data = bytes(range(256))*3
+    for i in range(0, len(data), 70):
+        spill.append(data[i:i+70])
+    assert not spill.spilled
+    assert bytes(spill.view) == data
+
+
+def test_spill_buffer_spills_to_disk():
+    spill = buffers.SpillBuffer(chunk_size=100, spill_size=300)
+    data = bytes(range(256))*8
+    for i in range(0, len(data), 90):
+        spill.append(data[i:i+90])
+        assert spill.spilled == (i + 90 > 300)
+    assert bytes(spill.view) == data
+    spill.clear()
+    assert not spill.spilled and len(spill) == 0
+    spill.append(b'abc')
+    assert bytes(spill.view) == b'abc'
+
+
+def test_spill_buffer_keeps_views_handed_out():
+    spill = buffers.SpillBuffer(chunk_size=100, spill_size=300)
+    spill.append(b'\x01'*80)
+    small = spill.view
+    #growing in memory, spilling and clearing all leave earlier views alone
+    spill.append(b'\x02'*80)
+    in_memory = spill.view
+    spill.append(b'\x03'*400)
+    spilled = spill.view
+    spill.clear()
+    spill.append(b'\x04'*500)
+    assert bytes(small) == b'\x01'*80
+    assert bytes(in_memory) == b'\x01'*80 + b'\x02'*80
+    assert bytes(spilled) == b'\x01'*80 + b'\x02'*80 + b'\x03'*400
+    assert bytes(spill.view) == b'\x04'*500
+
+
+def test_spill_buffer_empty_band():
+    #a DATA packet shorter than a page decodes to a band of no rows
+    spill = buffers.SpillBuffer()
+    spill.append(b'ab')
+    spill.append(np.zeros((0, 160), dtype=np.uint8))
+    spill.append(b'')
+    assert bytes(spill.view) == b'ab'
+
+
+def test_canvas_images_survive_clear():
+    gbtile = bytes(range(256))*10
+    canvas = image.TwobitCanvas(capacity=16, spill_size=640)
+    canvas.append(gbtile[:1280])
+    first = canvas.image()
+    expected = first.tobytes()
+    canvas.append(gbtile[1280:])
+    assert first.tobytes() == expected
+    canvas.clear()
+    canvas.append(bytes(1280))
+    assert first.tobytes() == expected
+    assert canvas.image().tobytes() == bytes([3])*160*32
@@ -0,0 +1,48 @@
+import pytest
+
+import benchmark
+import capture
+
+
+@pytest.mark.parametrize('line, kind', [
+    (b'88 33 0F 00 00 00 0F 00 81 00', capture.HEX_UPPER),
+    (b'88 33 0f 00 00 00 0f 00 81 00', capture.HEX_LOWER),
+    (b'GAMEBOY PRINTER Packet Capture V3.2.1', capture.RAW),
+    (b'88  33', capture.RAW),
+    (b'', capture.HEX_UPPER),
+])
+def test_pack_line(line, kind):
+    packed_kind, data = capture.pack_line(line)
+    assert packed_kind == kind
+    assert capture.unpack_line(packed_kind, data) == line
+
+
+def test_record_and_replay(tmp_path):
+    lines = benchmark.make_print_lines(9) + [b'junk'] + benchmark.make_print_lines(2, seed=9)
+    path = str(tmp_path / 'test.gbcap')
+    writer = capture.CaptureWriter(path)
+    for i, line in enumerate(lines):
+        writer.write(line, timestamp=i*0.01)
+    writer.close()
+    assert list(capture.read_capture(path)) == [(i*0.01, line) for i, line in enumerate(lines)]
+    for mode in ['convert_by_line', 'convert_by_page']:
+        packets, _ = capture.replay(path, **{mode: True})
+        assert packets == len(lines) - 1
+
+
+def test_truncated_capture(tmp_path):
+    path = str(tmp_path / 'test.gbcap')
+    writer = capture.CaptureWriter(path)
+    writer.write(b'88 33 01', timestamp=0)
+    writer.write(b'88 33 02', timestamp=1)
+    writer.close()
+    with open(path, 'r+b') as f:
+        f.truncate(f.seek(0, 2) - 1)
+    assert list(capture.read_capture(path)) == [(0, b'88 33 01')]
+
+
+def test_not_a_capture(tmp_path):
+    path = tmp_path / 'test.gbcap'
+    path.write_bytes(b'nope')
+    with pytest.raises(ValueError):
+        list(capture.read_capture(str(path)))
@@ -0,0 +1,57 @@
+import os
+
+import pytest
+
+import benchmark
+import daemon
+import image
+
+
+class ListSource:
+    """Hands out canned lines, then stops the daemon once they run out"""
+    def __init__(self, lines, stop):
+        self.lines = list(lines)
+        self.stop = stop
+
+    def init(self):
+        return self
+
+    def get_line(self, timeout=1):
+        if self.lines:
+            return self.lines.pop(0)
+        self.stop()
+        return b''
+
+    def shutdown(self):
+        pass
+
+
+def serve(tmp_path, monkeypatch, conversion, pages):
+    """Run one print through a daemon, returns it and the height of every preview"""
+    capture = daemon.CaptureDaemon(out_dir=str(tmp_path), conversion=conversion)
+    heights = []
+    write_preview = capture.write_preview
+    def spy(im):
+        heights.append(im.height)
+        write_preview(im)
+        assert os.path.exists(capture.preview)
+    monkeypatch.setattr(capture, 'write_preview', spy)
+    capture.emulator.init(ListSource(benchmark.make_print_lines(pages), capture.stop))
+    capture.serve()
+    image.save_queue.flush()
+    return capture, heights
+
+
+@pytest.mark.parametrize('conversion, expected', [
+    ('print', []),
+    #the emulator converts after each PRINT, and a Game Boy sends one every 9 pages
+    ('page', [9*16, 18*16]),
+    ('line', [16*i for i in range(1, 21)]),
+])
+def test_previews(tmp_path, monkeypatch, conversion, expected):
+    capture, heights = serve(tmp_path, monkeypatch, conversion, 20)
+    assert heights == expected
+    assert capture.prints == 1
+    #only the finished print is left, the preview goes once it is saved
+    [name] = os.listdir(tmp_path)
+    assert name != daemon.PREVIEW_NAME and name.endswith('.png')
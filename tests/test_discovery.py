@@ -0,0 +1,65 @@
+import time
+
+import pytest
+
+import emulator
+from benchmark import FakeDonglePort
+
+
+@pytest.fixture
+def fake_ports(monkeypatch, tmp_path):
+    ports = [f'/dev/ttyFAKE{i}' for i in range(20)]
+    monkeypatch.setattr(FakeDonglePort, 'dongle_port', ports[-1])
+    monkeypatch.setattr(FakeDonglePort, 'boot_time', 0.05)
+    monkeypatch.setattr(FakeDonglePort, 'opened', [])
+    monkeypatch.setattr(emulator.GBSerial, 'serial_class', FakeDonglePort)
+    monkeypatch.setattr(emulator.GBSerial, 'last_port', None)
+    monkeypatch.setattr(emulator.GBSerial, 'last_port_file', str(tmp_path / 'port'))
+    return ports
+
+
+def test_finds_dongle(fake_ports):
+    port, serial = emulator.GBSerial.find_dongle(fake_ports, timeout=2)
+    assert port == fake_ports[-1]
+    assert serial.port == port and not serial.closed
+    assert all(s.closed for s in FakeDonglePort.opened if s is not serial)
+    assert emulator.GBSerial.last_port == port
+
+
+def test_probes_in_parallel(fake_ports):
+    start = time.perf_counter()
+    emulator.GBSerial.find_dongle(fake_ports, timeout=2)
+    #one port at a time would wait for every silent port to time out first
+    assert time.perf_counter() - start < 1
+
+
+def test_last_port_probed_first(fake_ports, monkeypatch):
+    monkeypatch.setattr(emulator.GBSerial, 'max_probes', 1)
+    emulator.GBSerial.last_port = fake_ports[-1]
+    port, _ = emulator.GBSerial.find_dongle(fake_ports, timeout=2)
+    assert port == fake_ports[-1]
+    assert FakeDonglePort.opened[0].port == fake_ports[-1]
+
+
+def test_last_port_survives_restart(fake_ports, monkeypatch):
+    emulator.GBSerial.find_dongle(fake_ports, timeout=2)
+    #a new process starts without the class attribute, only the file
+    emulator.GBSerial.last_port = None
+    monkeypatch.setattr(emulator.GBSerial, 'max_probes', 1)
+    FakeDonglePort.opened.clear()
+    port, _ = emulator.GBSerial.find_dongle(fake_ports, timeout=2)
+    assert port == fake_ports[-1]
+    assert FakeDonglePort.opened[0].port == fake_ports[-1]
+
+
+def test_no_dongle(fake_ports, monkeypatch):
+    monkeypatch.setattr(FakeDonglePort, 'dongle_port', None)
+    assert emulator.GBSerial.find_dongle(fake_ports, timeout=0.3) is None
+    assert all(s.closed for s in FakeDonglePort.opened)
+    assert emulator.GBSerial.find_dongle([]) is None
+
+
+def test_init_with_port(fake_ports):
+    gbserial = emulator.GBSerial(fake_ports[-1]).init()
+    assert gbserial.port == fake_ports[-1]
+    assert [s.port for s in FakeDonglePort.opened] == [fake_ports[-1]]
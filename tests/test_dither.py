@@ -0,0 +1,26 @@
+import numpy as np
+import pytest
+
+import benchmark
+import image
+
+
+@pytest.mark.parametrize('diffusion', [image.floyd_steinberg, image.atkinson])
+@pytest.mark.parametrize('shape', [(32, 160), (7, 13), (1, 160), (32, 1)])
+def test_error_diffusion_matches_reference(diffusion, shape):
+    gray = benchmark.make_gray(2)[:shape[0], :shape[1]]
+    assert np.array_equal(diffusion(gray), benchmark.reference_error_diffusion(gray, diffusion))
+
+
+@pytest.mark.parametrize('pages', [1, 9, 100])
+def test_bayer_matches_legacy(pages):
+    gray = benchmark.make_gray(pages)
+    assert np.array_equal(image.bayer(gray), benchmark.legacy_bayer(gray))
+
+
+@pytest.mark.parametrize('mode', ['floydsteinberg', 'atkinson'])
+def test_registered(mode):
+    gray = benchmark.make_gray(1)
+    dithered = image.dither(gray, mode)
+    assert dithered.shape == gray.shape
+    assert set(np.unique(dithered)) <= {0, 85, 170, 255}
@@ -0,0 +1,97 @@
+import pytest
+
+import benchmark
+import emulator
+import image
+import metrics
+import printer
+import rle
+
+
+def feed(emu, packets):
+    """Handle every packet, returns what the emulator handed back for each"""
+    return [emu.handle_packet(emulator.GBPacket(packet)) for packet in packets]
+
+
+def test_short_data_packet_by_line():
+    emu = emulator.Emulator(convert_by_line=True)
+    rets = feed(emu, [printer.make_packet(emulator.INIT),
+                      printer.make_packet(emulator.DATA, bytes(320))])
+    assert rets[-1][1] == 'partial'
+    assert len(emu._fullimage) == 320
+
+
+def test_by_line_matches_by_print_with_short_packets():
+    gbtile = bytes(range(256))*5
+    packets = [printer.make_packet(emulator.INIT)]
+    packets += [printer.make_packet(emulator.DATA, gbtile[i:i+320]) for i in range(0, 1280, 320)]
+    packets += [printer.make_packet(emulator.DATA), printer.make_print_packet()]
+    by_line = feed(emulator.Emulator(convert_by_line=True), packets)[-1]
+    by_print = feed(emulator.Emulator(), packets)[-1]
+    assert by_line[1] == by_print[1] == 'complete'
+    assert by_line[0].tobytes() == by_print[0].tobytes() \
+        == image.gbtile_to_image(gbtile).tobytes()
+
+
+def test_short_compressed_page_is_padded():
+    emu = emulator.Emulator(convert_by_line=True)
+    feed(emu, [printer.make_packet(emulator.INIT),
+               printer.make_packet(emulator.DATA, rle.compress(b'\x55'*640), compressed=True)])
+    rets = feed(emu, [printer.make_packet(emulator.DATA, rle.compress(b'\x07'*600),
+                                          compressed=True)])
+    assert rets[-1][1] == 'partial'
+    assert bytes(emu._fullimage.view) == b'\x55'*640 + b'\x07'*600 + bytes(40)
+    assert emu.canvas.rows == 32
+
+
+def gbserial_reading(stream, chunk=64):
+    gbserial = emulator.GBSerial()
+    gbserial.serial = benchmark.FakeSerial(stream, chunk)
+    return gbserial
+
+
+@pytest.mark.parametrize('chunk', [1, 7, 64, 4096])
+def test_get_line_matches_legacy(chunk):
+    stream = b''.join(benchmark.make_hex_line(printer.make_packet(emulator.DATA, bytes([i])*640))
+                      for i in range(20))
+    gbserial = gbserial_reading(stream, chunk)
+    legacy = benchmark.FakeSerial(stream, chunk)
+    assert [gbserial.get_line() for _ in range(20)] == \
+        [benchmark.legacy_get_line(legacy) for _ in range(20)]
+
+
+def test_get_line_keeps_partial_line():
+    gbserial = gbserial_reading(b'88 33 01\r\n88 33')
+    timeouts = metrics.serial_timeouts.value()
+    assert gbserial.get_line(timeout=0.05) == b'88 33 01'
+    assert gbserial.get_line(timeout=0.05) == b''
+    assert metrics.serial_timeouts.value() == timeouts + 1
+    gbserial.serial.stream += b' 02\r\n'
+    assert gbserial.get_line(timeout=0.05) == b'88 33 02'
+
+
+def test_parse_matches_legacy():
+    packets = [bytearray(printer.make_packet(emulator.DATA, bytes([i])*640)) for i in range(5)]
+    packets[-1][-4] ^= 0xFF #bad checksum
+    lines = [benchmark.make_hex_line(packet).strip() for packet in packets]
+    emu = emulator.Emulator()
+    packets = [emu.parse_line(line) for line in lines]
+    assert [(bytes(p.data), p.is_valid() == 'VALID') for p in packets] == \
+        [benchmark.legacy_parse_packet(line) for line in lines]
+
+
+@pytest.mark.parametrize('line, reason', [
+    (b'GAMEBOY PRINTER Packet Capture V3.2.1', 'not_a_packet'),
+    (b'88 33 0Z 00', 'bad_hex'),
+    (b'88 33 01 00', 'too_short'),
+])
+def test_parse_failures(line, reason):
+    before = metrics.parse_failures.value(reason)
+    assert emulator.Emulator().parse_line(line) is None
+    assert metrics.parse_failures.value(reason) == before + 1
+
+
+def test_parse_keeps_bad_magic():
+    line = benchmark.make_hex_line(printer.make_packet(emulator.INIT)).strip()
+    packet = emulator.Emulator().parse_line(b'88 34' + line[5:])
+    assert packet.is_valid() == 'BAD_MAGIC_BYTES'
@@ -0,0 +1,62 @@
+import random
+
+import numpy as np
+import pytest
+
+import benchmark
+import image
+
+
+def test_canvas_joins_partial_pages():
+    gbtile = random.Random(0).randbytes(640*3)
+    canvas = image.TwobitCanvas()
+    ranges = [canvas.append(gbtile[a:b])
+              for a, b in [(0, 320), (320, 1000), (1000, 1000), (1000, 1920)]]
+    assert ranges == [(0, 0), (0, 16), (16, 16), (16, 48)]
+    assert np.array_equal(canvas.view, 3 - image.gbtile_to_twobit(gbtile))
+    canvas.clear()
+    canvas.append(gbtile[:320])
+    assert canvas.append(gbtile[320:640]) == (0, 16)
+    assert np.array_equal(canvas.view, 3 - image.gbtile_to_twobit(gbtile[:640]))
+
+
+def test_thumbnail_of_empty_print():
+    data, w, h = image.thumbnail_rgb(b'', 'gray')
+    assert (w, h) == (80, 8)
+    assert data == b'\xff'*3*w*h
+
+
+@pytest.mark.parametrize('pages', [1, 9, 100])
+def test_decode_matches_legacy(pages):
+    gbtile = benchmark.make_gbtile(pages)
+    twobit = image.gbtile_to_twobit(gbtile)
+    assert twobit.shape == (16*pages, 160)
+    assert np.array_equal(twobit, benchmark.legacy_gbtile_to_twobit(gbtile))
+
+
+@pytest.mark.parametrize('pages', [1, 9, 100])
+def test_encode_matches_legacy(pages):
+    gbtile = benchmark.make_gbtile(pages)
+    twobit = image.gbtile_to_twobit(gbtile)
+    encoded = image.twobit_to_gbtile(twobit)
+    assert encoded == benchmark.legacy_twobit_to_gbtile(twobit)
+    assert encoded == gbtile
+
+
+@pytest.mark.parametrize('scale', [1, 2, 3])
+@pytest.mark.parametrize('palette', ['gray', 'gbgreen'])
+def test_preview_matches_pil(scale, palette):
+    pil_image = image.gbtile_to_image(benchmark.make_camera_gbtile(9))
+    palette = image.palette_list(palette)
+    expected = benchmark.legacy_render_rgb(pil_image, palette, scale)
+    assert image.indices_to_rgb(np.asarray(pil_image), palette, scale) == expected
+
+
+@pytest.mark.parametrize('pages', [1, 9, 27])
+def test_thumbnail_is_top_of_print(pages):
+    gbtile = benchmark.make_camera_gbtile(pages)
+    palette = image.palette_list('gbgreen')
+    indices = np.asarray(image.gbtile_to_image(gbtile))[:144:2, ::2]
+    data, w, h = image.thumbnail_rgb(gbtile, palette)
+    assert (h, w) == indices.shape
+    assert data == image.indices_to_rgb(indices, palette)
@@ -0,0 +1,58 @@
+import random
+
+import benchmark
+import emulator
+import metrics
+import printer
+
+
+def print_lines(pages):
+    """Hex lines for a compressed print with a bad checksum and bad magic packet"""
+    rng = random.Random(0)
+    data = [printer.make_data_packet(bytes([rng.randrange(4)])*640, compress=True)
+            for _ in range(pages)]
+    bad_checksum = bytearray(data[0])
+    bad_checksum[-4] ^= 0xFF
+    bad_magic = bytearray(data[0])
+    bad_magic[1] = 0x34
+    packets = [bad_checksum, bad_magic, printer.make_packet(emulator.INIT)] + data + \
+        [printer.make_packet(emulator.DATA), printer.make_print_packet()]
+    return [benchmark.make_hex_line(packet).strip() for packet in packets] + [b'junk']
+
+
+def test_counters_add_up():
+    pages = 9
+    before = metrics.snapshot()
+    emu = emulator.Emulator()
+    images = 0
+    for line in print_lines(pages):
+        packet = emu.parse_line(line)
+        if packet:
+            ret = emu.handle_packet(packet)
+            if ret and ret[0] is not None:
+                images += 1
+    after = metrics.snapshot()
+
+    def delta(name, label=''):
+        return after[name].get(label, 0) - before[name].get(label, 0)
+    assert images == 1
+    assert delta('gbp_packets_total', 'DATA') == pages + 1
+    assert delta('gbp_packets_total', 'PRINT') == 1
+    assert delta('gbp_packet_errors_total', 'BAD_CHECKSUM') == 1
+    assert delta('gbp_packet_errors_total', 'BAD_MAGIC_BYTES') == 1
+    assert delta('gbp_parse_failures_total', 'not_a_packet') == 1
+    before_count = before.get('gbp_read_to_image_seconds', {}).get('', {}).get('count', 0)
+    assert after['gbp_read_to_image_seconds']['']['count'] == before_count + images
+
+
+def test_prometheus_text():
+    metrics.packets.inc(label_value='DATA')
+    metrics.serial_bytes.inc(123456789)
+    metrics.handle_seconds.observe(0.0012345678, 'DATA')
+    text = metrics.prometheus_text()
+    assert 'gbp_packets_total{command="DATA"}' in text
+    #big counters and small sums keep every digit
+    assert f'gbp_serial_bytes_total {metrics.serial_bytes.value()}\n' in text
+    total = metrics.handle_seconds.snapshot()['DATA']['sum']
+    assert f'gbp_handle_packet_seconds_sum{{command="DATA"}} {total!r}\n' in text
+    assert 'le="+Inf"' in text
@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+
+import benchmark
+import emulator
+import image
+import printer
+
+
+@pytest.mark.parametrize('payload, compressed', [(b'', False), (bytes(range(256))*3, True)])
+def test_make_packet(payload, compressed):
+    packet = emulator.GBPacket(printer.make_packet(emulator.DATA, payload, compressed))
+    assert packet.is_valid() == 'VALID'
+    assert packet.command == emulator.DATA
+    assert packet.compressed == compressed
+    assert bytes(packet.data) == payload
+
+
+@pytest.mark.parametrize('pages', [1, 9, 27])
+@pytest.mark.parametrize('compress', [False, True])
+def test_loopback_print(pages, compress):
+    gbtile = benchmark.make_camera_gbtile(pages)
+    images, _ = printer.loopback_print(gbtile, compress=compress)
+    assert len(images) == 1
+    assert np.array_equal(np.asarray(images[0]), np.asarray(image.gbtile_to_image(gbtile)))
+
+
+class JammedLink(printer.Link):
+    def send(self, packet):
+        return 1 << emulator.PAPER_JAM
+
+
+def test_printer_error():
+    driver = printer.PrinterDriver(JammedLink(), poll_interval=0)
+    with pytest.raises(printer.PrinterError, match='PAPER_JAM'):
+        driver.print_gbtile(bytes(640))
+    driver.shutdown()
@@ -0,0 +1,48 @@
+import json
+import os
+
+import pytest
+
+import benchmark
+import emulator
+import image
+import profiling
+
+
+def handle_print(pages=2):
+    emu = emulator.Emulator()
+    for line in benchmark.make_print_lines(pages, compressed=True):
+        emu.handle_packet(emu.parse_line(line))
+
+
+@pytest.mark.parametrize('profile_packets', [0, 3])
+def test_start_and_stop(tmp_path, profile_packets):
+    handle_packet = emulator.Emulator.handle_packet
+    gbtile_to_image = image.gbtile_to_image
+    profiling.start(str(tmp_path), profile_packets=profile_packets)
+    try:
+        assert emulator.Emulator.handle_packet is not handle_packet
+        handle_print()
+    finally:
+        profiling.stop()
+    #switched off, the original functions are back
+    assert emulator.Emulator.handle_packet is handle_packet
+    assert image.gbtile_to_image is gbtile_to_image
+    with open(tmp_path / 'spans.json') as f:
+        events = json.load(f)['traceEvents']
+    assert {event['name'] for event in events} == {'Emulator.handle_packet', 'gbtile_to_image'}
+    assert os.path.exists(tmp_path / 'spans.txt')
+    assert os.path.exists(tmp_path / 'profile.pstats') == bool(profile_packets)
+
+
+def test_start_from_env(tmp_path, monkeypatch):
+    monkeypatch.delenv(profiling.ENV_DIR, raising=False)
+    assert profiling.start_from_env() is None
+    monkeypatch.setenv(profiling.ENV_DIR, str(tmp_path))
+    monkeypatch.setenv(profiling.ENV_PACKETS, '2')
+    profiler = profiling.start_from_env()
+    try:
+        assert profiler.out_dir == str(tmp_path)
+        assert profiler.profile_packets == 2
+    finally:
+        profiling.stop()
@@ -0,0 +1,51 @@
+import random
+
+import pytest
+
+import rle
+
+
+def camera_page(seed=0):
+    """A 640-byte page of runs broken up by noise, roughly like a camera print"""
+    rng = random.Random(seed)
+    page = bytearray()
+    while len(page) < 640:
+        if rng.random() < 0.5:
+            page += bytes([rng.randrange(256)]) * rng.randrange(2, 200)
+        else:
+            page += bytes(rng.randrange(256) for _ in range(rng.randrange(1, 40)))
+    return bytes(page[:640])
+
+
+@pytest.mark.parametrize('raw', [
+    b'', b'\x00', b'\x00\x01', b'\x07'*3, b'\x07'*129, b'\x07'*130, b'\x07'*131,
+    b'\x07'*640, bytes(range(256)) + bytes(range(256)),
+    random.Random(0).randbytes(640), camera_page(),
+])
+def test_roundtrip(raw):
+    #a short page comes back as a whole one, padded with zeros
+    assert bytes(rle.decompress(rle.compress(raw))) == raw + bytes(640 - len(raw))
+
+
+def test_decompress_into_buffer():
+    raw = camera_page(1)
+    out = bytearray(640)
+    assert bytes(rle.decompress(rle.compress(raw), out)) == raw
+    assert out == raw
+
+
+def test_short_page_clears_reused_buffer():
+    out = bytearray(b'\xff'*640)
+    page = rle.decompress(rle.compress(b'\x07'*600), out)
+    assert len(page) == 640
+    assert bytes(page) == b'\x07'*600 + bytes(40)
+
+
+@pytest.mark.parametrize('bad', [
+    b'\x80',                    #run with no byte to repeat
+    b'\x05\x00',                #literal cut short
+    b'\xff\x00'*5 + b'\xff\x00',  #runs past the end of the page
+])
+def test_malformed(bad):
+    with pytest.raises(ValueError):
+        rle.decompress(bad)
@@ -0,0 +1,12 @@
+import pytest
+
+import benchmark
+
+
+@pytest.mark.parametrize('name', sorted(benchmark.STARTUP_SCRIPTS))
+def test_heavy_modules_stay_unloaded(name):
+    startup = benchmark.time_startup(name, repeat=1)
+    if startup is None:
+        pytest.skip(f'{name} can not start here')
+    _, _, loaded = startup
+    assert loaded == benchmark.HEAVY_MODULES[name]
@@ -1,28 +1,36 @@
 import wx
-import PIL.Image
+import os
+import tempfile
 import threading
 import time
 import logging
-from serial.serialutil import SerialException
 from random import randint
+from collections import OrderedDict
 from pubsub import pub
 
+import archive
 import emulator
+import gallery
 import image
+import lazy
+
+np = lazy.lazy_import('numpy')
 
 log = logging.getLogger(__name__)
 
 class MainWindow(wx.Frame):
 
-    def __init__(self):
+    def __init__(self, max_fps=30, archive_path=None):
         wx.Frame.__init__(self, parent=None, title='GBPrinter')
         self.status_bar = self.CreateStatusBar()
+        self.max_fps = max_fps
+        self.open_archive(archive_path)
         self.create_other_stuff()
         self.create_layout()
         self.update_palette('gray')
         self.update_image()
         pub.subscribe(self.from_printer_msg, 'from_printer_msg')
-        pub.subscribe(self.from_printer_img, 'from_printer_img')
+        pub.subscribe(self.post_printer_img, 'from_printer_img')
 
     def create_layout(self):
 
@@ -140,6 +148,14 @@ class MainWindow(wx.Frame):
         self.output_bitmap = wx.StaticBitmap(self.image_panel)
         self.main_sizer.Add(self.image_panel, flag=wx.ALL, border=5)
 
+
+        """
+        PRINT HISTORY
+        """
+        self.gallery = gallery.GalleryList(self.main_panel, self.archive, size=(200, -1))
+        self.gallery.Bind(wx.EVT_LISTBOX, self.on_gallery_select)
+        self.main_sizer.Add(self.gallery, flag=wx.EXPAND | wx.ALL, border=5)
+
         """
         ALL DONE
         """
@@ -148,22 +164,66 @@ class MainWindow(wx.Frame):
 
     def create_other_stuff(self):
         self.log = logging.getLogger('window')
-        self.emulator = emulator.Emulator(convert_by_line=True)
-        image_data = bytes([0]*160*72 + [1]*160*72 + [2]*160*72 + [3]*160*72)
-        self.pil_image = PIL.Image.frombytes('P',(160,144*2), image_data)
+        self.emulator = emulator.Emulator(convert_by_line=True, archive=self.archive)
+        #no image until the first print, the placeholder needs no numpy or PIL
+        self.pil_image = None
+        self.pil_indices = None
+        self.image_version = 0
+        self.bitmap_cache = OrderedDict()
+        self.bitmap_cache_size = 8
         self.clear_status_timer = wx.Timer(self)
         self.Bind(wx.EVT_TIMER, self.on_clear_status, self.clear_status_timer)
+        self._pending_lock = threading.Lock()
+        self._pending_img = None
+        self._pending_complete = []
+        self._refresh_queued = False
+        self._last_refresh = 0
 
     def from_printer_msg(self, msg):
         self.log.debug(f'Got message from printer: {msg}')
         if msg == 'abort':
             self.shutdown_emulator()
 
-    def from_printer_img(self, img, status):
-        self.log.info(f'Received image from printer thread with status {status}')
+    def post_printer_img(self, img, status):
+        """
+        Called from the printer thread. Only the newest image is kept, and
+        at most one refresh is queued on the GUI thread at a time, so a burst
+        of packets costs one repaint.
+        """
+        with self._pending_lock:
+            if img is not None:
+                self._pending_img = img
+            if status == 'complete':
+                self._pending_complete.append(img)
+            if self._refresh_queued:
+                return
+            self._refresh_queued = True
+        wx.CallAfter(self.queue_refresh)
+
+    def queue_refresh(self):
+        """Refresh now, or once enough time has passed to keep under max_fps"""
+        delay = self._last_refresh + 1/self.max_fps - time.monotonic()
+        if delay > 0:
+            wx.CallLater(int(delay*1000) + 1, self.from_printer_img)
+        else:
+            self.from_printer_img()
+
+    def from_printer_img(self):
+        with self._pending_lock:
+            img = self._pending_img
+            complete = self._pending_complete
+            self._pending_img = None
+            self._pending_complete = []
+            self._refresh_queued = False
+        self._last_refresh = time.monotonic()
+        self.log.info(f'Received image from printer thread, {len(complete)} complete')
         self.update_image(img)
-        if status == 'complete' and self.auto_save_toggle.GetValue():
-            self.pil_image.save(time.strftime('gbp_out/gbp_%Y%m%d_%H%M%S.png'),'PNG')
+        if complete:
+            self.gallery.refresh()
+        if complete and self.auto_save_toggle.GetValue():
+            for complete_img in complete:
+                complete_img.putpalette(self.palette)
+                image.save_image(complete_img.copy())
             self.SetStatusText("Autosaved complete image!")
             self.clear_status_later()
 
@@ -171,8 +231,12 @@ class MainWindow(wx.Frame):
     def update_image(self, image=None):
         if image:
             self.pil_image = image
-        self.pil_image.putpalette(self.palette)
-        self.output_image = self.pil_image_to_wx_bitmap(self.pil_image, self.scale)
+            self.pil_indices = np.asarray(image)
+            self.image_version += 1
+        if self.pil_image is not None:
+            self.pil_image.putpalette(self.palette)
+        self.gallery.set_palette(self.palette)
+        self.output_image = self.cached_bitmap()
         self.output_bitmap.SetBitmap(self.output_image)
 
         self.image_panel.SetVirtualSize(self.output_bitmap.GetSize())
@@ -184,18 +248,47 @@ class MainWindow(wx.Frame):
 
         self.main_sizer.Fit(self)
 
+    def cached_bitmap(self):
+        """
+        Bitmap of the current image in the current palette and scale, reused
+        if it has been rendered before, so recoloring or rezooming back and
+        forth costs nothing
+        """
+        key = (self.image_version, tuple(self.palette), self.scale)
+        bitmap = self.bitmap_cache.get(key)
+        if bitmap is None:
+            if self.pil_indices is None:
+                bitmap = self.placeholder_bitmap(self.palette, self.scale)
+            else:
+                bitmap = self.indices_to_wx_bitmap(self.pil_indices, self.palette, self.scale)
+            self.bitmap_cache[key] = bitmap
+            while len(self.bitmap_cache) > self.bitmap_cache_size:
+                self.bitmap_cache.popitem(last=False)
+        else:
+            self.bitmap_cache.move_to_end(key)
+        return bitmap
 
     @staticmethod
-    def pil_image_to_wx_bitmap(pil_image, scale=2):
+    def placeholder_bitmap(palette, scale=2):
+        """Four bands of the palette colours, shown before the first print"""
+        wx_img = wx.Image(160*scale, 288*scale)
+        wx_img.SetData(b''.join(bytes(palette[3*i:3*i+3]) * (160*scale * 72*scale)
+                                for i in range(4)))
+        return wx_img.ConvertToBitmap()
+
+    @staticmethod
+    def indices_to_wx_bitmap(indices, palette, scale=2):
         """Note that I don't have to worry about transparency"""
-        w, h = pil_image.size
+        h, w = indices.shape
         wx_img = wx.Image(w*scale, h*scale)
-        resized_img = pil_image.resize((w*scale, h*scale), PIL.Image.NEAREST)
-        pil_img_data = resized_img.convert('RGB').tobytes()
-        wx_img.SetData(pil_img_data)
+        wx_img.SetData(image.indices_to_rgb(indices, palette, scale))
         return wx_img.ConvertToBitmap()
 
     def on_manual_save(self, e):
+        if self.pil_image is None:
+            self.SetStatusText("Nothing printed yet!")
+            self.clear_status_later()
+            return
         with wx.FileDialog(self, "Save Image", 
                            wildcard="PNG File (*.png)|*.png",
                            style=wx.FD_SAVE | wx.FD_OVERWRITE_PROMPT) as fileDialog:
@@ -228,6 +321,7 @@ class MainWindow(wx.Frame):
         new_color = e.GetColour()
         for i in range(3):
             self.palette[3*color_slot+i] = new_color[i]
+        self.emulator.palette = image.palette_hex(self.palette)
         self.update_image()
         self.SetStatusText(f"Color {color_slot} updated to {new_color[:-1]}")
         self.clear_status_later()
@@ -238,32 +332,29 @@ class MainWindow(wx.Frame):
 
     def update_palette(self, palette_name):
         self.palette = image.palette_convert(image.PALETTES[palette_name])
+        #prints are archived in the palette they were shown in
+        self.emulator.palette = image.PALETTES[palette_name]
         for i in range(4):
             self.color_buttons[i].SetColour(wx.Colour(self.palette[i*3:i*3+3]))
 
     def on_connect_button(self, e):
         self.SetStatusText(f'Scanning serial ports for dongle...')
         self.connect_button.Disable()
-        good_ports = emulator.GBSerial.find_serial_ports()
-        for port in good_ports:
-            try:
-                self.SetStatusText(f'Checking {port} for dongle...')
-                gbserial = emulator.GBSerial()
-                self.emulator.init(gbserial)
-                st = f'Connected to {gbserial.port}'
-                self.serial_status.SetLabel(gbserial.port)
-                self.SetStatusText(st)
-                self.clear_status_later()
-                self.connect_button.Disable()
-                self.disconnect_button.Enable()
-                PrinterThread(self.emulator)
-                break
-            except IOError:
-                pass
-        else:
+        gbserial = emulator.GBSerial()
+        try:
+            self.emulator.init(gbserial)
+        except IOError:
             self.connect_button.Enable()
             self.SetStatusText("Didn't find a printer dongle!")
             self.clear_status_later()
+            return
+        st = f'Connected to {gbserial.port}'
+        self.serial_status.SetLabel(gbserial.port)
+        self.SetStatusText(st)
+        self.clear_status_later()
+        self.connect_button.Disable()
+        self.disconnect_button.Enable()
+        PrinterThread(self.emulator)
 
     def on_disconnect_button(self, e):
         pub.sendMessage('to_printer', msg='abort')
@@ -290,6 +381,35 @@ class MainWindow(wx.Frame):
         dlg.ShowModal()
         dlg.Destroy()
 
+    def open_archive(self, path=None):
+        """
+        Every complete print goes into an archive for the history panel,
+        a temporary one for this session only unless a path is given
+        """
+        self.session_archive = path is None
+        if path is None:
+            fd, path = tempfile.mkstemp(prefix='gbp_', suffix='.gbarc')
+            os.close(fd)
+        self.archive = archive.PrintArchive(path)
+        self.Bind(wx.EVT_CLOSE, self.on_close)
+
+    def on_close(self, e):
+        self.emulator.archive = None
+        self.archive.close()
+        if self.session_archive:
+            for path in [self.archive.path, self.archive.index_path]:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        e.Skip()
+
+    def on_gallery_select(self, e):
+        printed = self.archive[e.GetSelection()]
+        self.update_image(printed.image())
+        self.SetStatusText(f'Showing print #{printed.number + 1}, {printed.pages} pages')
+        self.clear_status_later()
+
     def on_exit(self, e):
         self.Close(True)  # Close the frame.
 
@@ -311,7 +431,7 @@ class PrinterThread(threading.Thread):
             try:
                 line = self.emulator.get_line()
             except:
-                pub.sendMessage('from_printer_msg', msg='abort')
+                wx.CallAfter(pub.sendMessage, 'from_printer_msg', msg='abort')
                 log.info('Serial error, closing connection')
                 break
             packet = self.emulator.parse_line(line)